@@ -0,0 +1,179 @@
+"""
+Benchmark oa2zenodo.py end-to-end against mock_server.py, with a synthetic event and upload folder tree.
+Reports throughput, per-stage latency percentiles (from oa2zenodo's metrics file), per-endpoint latency percentiles
+(as observed by the mock server) and peak memory of oa2zenodo.py.
+
+python3 benchmark.py --submissions 200 --workers 1 4 8 --latency 0.05 --json results.json
+python3 benchmark.py --submissions 200 --workers 4 --compare results.json
+
+Peak memory is measured with os.wait4, so this requires a Unix-like OS.
+"""
+import argparse, csv, json, os, subprocess, sys, tempfile, time
+from collections import defaultdict
+from mock_server import MockServer, generate_event, generate_files, add_server_arguments, percentile
+
+CONFIG_TEMPLATE = """[OXFORD_ABSTRACTS]
+api_key=benchmark
+event_id=1
+api_url={url}v1/graphql
+cache_ttl=0
+page_size={page_size}
+
+[ZENODO]
+api_key=benchmark
+api_url={url}
+use_sandbox=TRUE
+dry_run=FALSE
+draft_only=FALSE
+fake_upload=FALSE
+workers={workers}
+file_workers={file_workers}
+upload_order={upload_order}
+requests_per_minute=0
+max_retries={max_retries}
+upload_chunk_size={chunk_size}
+file_search_root={upload_root}
+file_blacklist=
+  desktop.ini
+keywords=
+  benchmark
+community_identifiers=
+  benchmark
+conference_title=Benchmark Conference
+conference_acronym=BENCH
+conference_dates=1 January 2024
+conference_place=Localhost
+conference_url=http://localhost/
+"""
+
+OA2ZENODO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "oa2zenodo.py")
+
+def run(args, workers, upload_root, upload_bytes, submissions, program_dates):
+    """Run oa2zenodo.py once against a fresh mock server, returning its results."""
+    server = MockServer(submissions, program_dates, latency=args.latency, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+        requests_per_minute=args.requests_per_minute, seed=args.seed).start()
+    # Each run has its own working directory, so no state/cache/index is shared between runs
+    with tempfile.TemporaryDirectory() as run_dir:
+        conf_path = os.path.join(run_dir, "benchmark.ini")
+        with open(conf_path, "w") as conf_file:
+            conf_file.write(CONFIG_TEMPLATE.format(url=server.url, workers=workers, file_workers=args.file_workers, upload_order=args.upload_order, page_size=args.page_size,
+                max_retries=args.max_retries, chunk_size=args.chunk_size, upload_root=upload_root))
+        with open(os.path.join(run_dir, "stdout.txt"), "w") as out:
+            start = time.monotonic()
+            p = subprocess.Popen([sys.executable, OA2ZENODO, conf_path], cwd=run_dir,
+                stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT)
+            _, status, rusage = os.wait4(p.pid, 0)
+            elapsed = time.monotonic() - start
+        with open(os.path.join(run_dir, "oa2zenodo_log.csv"), newline="") as logfile:
+            statuses = [row["status"] for row in csv.DictReader(logfile)]
+        # Client-side timing of each stage
+        stage_durations = defaultdict(list)
+        with open(os.path.join(run_dir, "oa2zenodo_metrics.jsonl")) as metrics_file:
+            for line in metrics_file:
+                entry = json.loads(line)
+                stage_durations[entry["stage"]].append(entry["seconds"])
+        stages = {}
+        for stage, durations in stage_durations.items():
+            d = sorted(durations)
+            stages[stage] = {"count": len(d), "p50": percentile(d, 50), "p90": percentile(d, 90),
+                "p99": percentile(d, 99), "max": d[-1]}
+        if status and args.verbose:
+            with open(os.path.join(run_dir, "stdout.txt")) as out:
+                print(out.read())
+    server.stop()
+    stats = server.summary()
+    published = sum(1 for s in statuses if s == "Zenodo record created and published")
+    return {
+        "workers": workers,
+        "file_workers": args.file_workers,
+        "upload_order": args.upload_order,
+        "exit_status": os.waitstatus_to_exitcode(status),
+        "seconds": elapsed,
+        "submissions": len(submissions),
+        "published": published,
+        "failed": sum(1 for s in statuses if "error" in s or "failed" in s.lower()),
+        "records_per_second": published / elapsed,
+        "upload_bytes": upload_bytes,
+        "bytes_received": stats["bytes_received"],
+        "mb_per_second": stats["bytes_received"] / elapsed / (1024*1024),
+        # ru_maxrss is KB on Linux
+        "peak_memory_mb": rusage.ru_maxrss / 1024,
+        "stages": stages,
+        "endpoints": stats["endpoints"],
+        "status_counts": stats["status_counts"],
+    }
+
+def report(result):
+    print(f"\nworkers={result['workers']}: {result['seconds']:.2f}s, exit status {result['exit_status']}")
+    print(f"  {result['published']}/{result['submissions']} published, {result['failed']} log rows with errors")
+    print(f"  {result['records_per_second']:.2f} records/s, {result['mb_per_second']:.2f} MB/s "
+        f"({result['bytes_received']/(1024*1024):.1f} of {result['upload_bytes']/(1024*1024):.1f} MB file data received)")
+    print(f"  peak memory {result['peak_memory_mb']:.1f} MB, responses {result['status_counts']}")
+    for heading, timings in (("stage", result["stages"]), ("endpoint", result["endpoints"])):
+        print(f"  {heading:<12}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for name, s in sorted(timings.items()):
+            print(f"  {name:<12}{s['count']:>7}{s['p50']*1000:>10.1f}{s['p90']*1000:>10.1f}{s['p99']*1000:>10.1f}{s['max']*1000:>10.1f}")
+
+def settings(result):
+    """The settings a result was run with, only results with the same settings are comparable."""
+    # Results written before file_workers/upload_order existed used their defaults
+    return result["workers"], result.get("file_workers", 1), result.get("upload_order", "plan")
+
+def compare(results, baseline_path, tolerance):
+    """Returns False if any run's throughput regressed by more than tolerance versus the baseline with the same settings."""
+    with open(baseline_path) as baseline_file:
+        baseline = {settings(r): r for r in json.load(baseline_file)}
+    ok = True
+    for r in results:
+        b = baseline.get(settings(r))
+        if not b:
+            print(f"workers={r['workers']}, file_workers={r['file_workers']}, upload_order={r['upload_order']}: no baseline with these settings")
+            continue
+        change = r["records_per_second"] / b["records_per_second"] - 1 if b["records_per_second"] else 0
+        regressed = change < -tolerance
+        ok = ok and not regressed
+        print(f"workers={r['workers']}, file_workers={r['file_workers']}, upload_order={r['upload_order']}: "
+            f"{r['records_per_second']:.2f} vs baseline {b['records_per_second']:.2f} records/s "
+            f"({change*100:+.1f}%){' REGRESSION' if regressed else ''}")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark oa2zenodo.py against local mock APIs")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="Worker counts to benchmark.")
+    parser.add_argument("--files-per-submission", type=int, default=3, help="Maximum files per upload folder.")
+    parser.add_argument("--file-workers", type=int, default=1, help="oa2zenodo file_workers.")
+    parser.add_argument("--upload-order", default="plan", choices=["plan", "smallest", "largest"], help="oa2zenodo upload_order.")
+    parser.add_argument("--median-file-size", type=int, default=256*1024, help="Median bytes of generated files.")
+    parser.add_argument("--file-size-sigma", type=float, default=1.0, help="Sigma of the log-normal file size distribution.")
+    parser.add_argument("--page-size", type=int, default=50, help="Oxford Abstracts page_size.")
+    parser.add_argument("--max-retries", type=int, default=5, help="oa2zenodo max_retries.")
+    parser.add_argument("--chunk-size", type=int, default=1024*1024, help="oa2zenodo upload_chunk_size.")
+    parser.add_argument("--json", help="Write results to this file.")
+    parser.add_argument("--compare", help="Compare throughput against results previously written with --json.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Fractional throughput drop permitted by --compare.")
+    parser.add_argument("--verbose", action="store_true", help="Print oa2zenodo.py output of failed runs.")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    submissions, program_dates = generate_event(args.submissions, args.authors, args.abstract_size, seed=args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as upload_root:
+        # Only submissions with permission to publish have their files uploaded
+        permitted = [s["serial_number"] for s in submissions
+            if any(r["question"]["question_name"] == "Permission to Publish" and r["value"] == "yes" for r in s["responses"])]
+        generate_files(upload_root, [s["serial_number"] for s in submissions if s["serial_number"] not in permitted],
+            args.files_per_submission, args.median_file_size, args.file_size_sigma, seed=args.seed + 1)
+        upload_bytes = generate_files(upload_root, permitted, args.files_per_submission, args.median_file_size,
+            args.file_size_sigma, seed=args.seed)
+        print(f"Synthetic event: {len(submissions)} submissions, {len(permitted)} with permission, "
+            f"{upload_bytes/(1024*1024):.1f} MB to upload")
+        for workers in args.workers:
+            result = run(args, workers, upload_root, upload_bytes, submissions, program_dates)
+            report(result)
+            results.append(result)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
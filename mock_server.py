@@ -0,0 +1,454 @@
+"""
+Local stand-in for the Oxford Abstracts GraphQL API and the Zenodo deposition API,
+so that oa2zenodo.py can be exercised and benchmarked without the live (sandbox) services.
+
+A synthetic event is generated on startup, and the server's latency, error rates and rate limits are configurable.
+Point oa2zenodo.py at it by setting 'api_url' in both config sections, e.g.
+[OXFORD_ABSTRACTS] api_url=http://127.0.0.1:8080/v1/graphql
+[ZENODO] api_url=http://127.0.0.1:8080/
+
+Per-endpoint latencies observed by the server are available from GET /_stats
+"""
+import argparse, hashlib, http.server, itertools, json, math, os, random, re, socket, threading, time, uuid
+from collections import defaultdict
+from urllib.parse import urlparse, unquote
+
+ACCEPTED_FOR = ["Talk", "Walkthrough", "Poster & Lightning Talk", "Workshop", "Birds of a Feather", "Hackathon"]
+
+def generate_event(submissions=100, authors=3, abstract_size=1000, permission_rate=0.9, session_size=4, seed=0):
+    """
+    Generate Oxford Abstracts style submission and programme data for a synthetic event.
+    Each submission has 1-authors authors, and appears in exactly one programme session (so no prompts occur).
+    Returns (submissions, program_dates) as they would appear within events_by_pk.
+    """
+    rng = random.Random(seed)
+    oa_submissions = []
+    for i in range(submissions):
+        oa_submissions.append({
+            "decision": {"value": "Accepted"},
+            "title": [{"without_html": f"Synthetic submission {i+1}"}],
+            "authors": [{
+                "first_name": f"First{j}",
+                "last_name": f"Last{i}_{j}",
+                "orcid_id": f"0000-0000-0000-{j:04d}" if rng.random() < 0.5 else None,
+                "affiliations": [{"institution": f"University {k}"} for k in range(rng.randint(0, 2))],
+                "presenting": j == 0,
+                "title": "",
+                "email": f"author{i}_{j}@example.com",
+            } for j in range(rng.randint(1, authors))],
+            "accepted_for": {"value": rng.choice(ACCEPTED_FOR)},
+            "responses": [
+                {"value": "x" * abstract_size, "question": {"question_name": "Abstract"}},
+                {"value": "yes" if rng.random() < permission_rate else "no", "question": {"question_name": "Permission to Publish"}},
+            ],
+            "id": 100000 + i,
+            "serial_number": i + 1,
+        })
+    sessions = []
+    for s in range(0, submissions, session_size):
+        sessions.append({
+            "name": f"Session {s//session_size + 1}",
+            "program_sessions_submissions": [{
+                "submission": {
+                    "title": sub["title"],
+                    "serial_number": sub["serial_number"],
+                    "archived": False,
+                    "decision": sub["decision"],
+                },
+                "submission_id": sub["id"],
+            } for sub in oa_submissions[s:s+session_size]],
+            "colour": "#ffffff",
+            "program_sessions_program_columns": [{"program_column": {"name": f"Track {(s//session_size) % 3 + 1}"}}],
+            "start_time": "09:00",
+            "end_time": "10:00",
+        })
+    # A session without submissions or columns is treated as plenary
+    sessions.append({"name": "Keynote", "program_sessions_submissions": [], "colour": "#000000",
+        "program_sessions_program_columns": [], "start_time": "08:00", "end_time": "09:00"})
+    return oa_submissions, [{"program_date": "2024-09-03", "program_sessions": sessions}]
+
+def generate_files(root, serial_numbers, files_per_submission=3, median_size=1024*1024, sigma=1.0, max_size=512*1024*1024, seed=0):
+    """
+    Create an upload folder "ID <serial>" per submission beneath root, containing files with log-normally distributed sizes.
+    Files are created sparse (zero-filled), so generation is fast regardless of size.
+    Returns the total bytes of files that oa2zenodo.py should upload.
+    """
+    rng = random.Random(seed)
+    total = 0
+    for serial in serial_numbers:
+        # Nest folders similarly to the real upload tree
+        folder = os.path.join(root, f"Group {serial % 10}", f"ID {serial}")
+        os.makedirs(folder, exist_ok=True)
+        for j in range(rng.randint(1, files_per_submission)):
+            size = min(max_size, max(1, int(rng.lognormvariate(math.log(median_size), sigma))))
+            with open(os.path.join(folder, f"file_{j}.pdf"), "wb") as f:
+                f.truncate(size)
+            total += size
+        # Should be ignored by the default blacklist
+        with open(os.path.join(folder, "desktop.ini"), "w") as f:
+            f.write("[.ShellClassInfo]\n")
+    return total
+
+def percentile(values, p):
+    """Nearest-rank percentile, values must be sorted."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+class MockServer:
+    """
+    Threaded HTTP server emulating both APIs.
+    latency: mean seconds added to each response (exponentially distributed)
+    error_rate: fraction of requests which fail with 503
+    throttle_rate: fraction of requests which fail with 429 and Retry-After
+    requests_per_minute: if non-zero, requests beyond this in a 60s window fail with 429 and X-RateLimit-* headers
+    faults: {endpoint: [fault]}, each request to the endpoint takes the next fault, None (no fault) or a dict of
+        status: respond with this status, without processing the request unless processed is true
+        headers: headers of the status response, e.g. Retry-After
+        delay: seconds to wait before responding, e.g. to cause a read timeout
+    """
+    def __init__(self, submissions, program_dates, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0,
+            throttle_rate=0.0, retry_after=1, requests_per_minute=0, seed=0):
+        self.submissions = submissions
+        self.program_dates = program_dates
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.requests_per_minute = requests_per_minute
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.depositions = {}
+        self.buckets = {} # bucket id: deposition id
+        self.stats = defaultdict(list) # endpoint: [seconds]
+        self.faults = defaultdict(list)
+        self.status_counts = defaultdict(int)
+        self.bytes_received = 0
+        self.window_start = time.time()
+        self.window_count = 0
+        self.httpd = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}/"
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def summary(self):
+        """Per-endpoint request counts and latency percentiles (seconds)."""
+        with self.lock:
+            endpoints = {}
+            for endpoint, durations in self.stats.items():
+                d = sorted(durations)
+                endpoints[endpoint] = {"count": len(d), "p50": percentile(d, 50), "p90": percentile(d, 90),
+                    "p99": percentile(d, 99), "max": d[-1]}
+            return {"endpoints": endpoints, "status_counts": dict(self.status_counts), "bytes_received": self.bytes_received}
+
+    def _deposition(self, zenodo_id):
+        d = self.depositions.get(zenodo_id)
+        if d is None:
+            raise KeyError(zenodo_id)
+        return d
+
+    def _handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            fault_response = None
+
+            def log_message(self, format, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                # Headers and body are written separately, so without this Nagle's algorithm and delayed ACKs
+                # add ~40ms to every response, dwarfing the latency being measured
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def send_json(self, code, obj=None, headers=None):
+                # A fault of a processed request replaces the handler's response
+                if self.fault_response:
+                    code, headers = self.fault_response
+                    obj = {"message": "Injected fault", "status": code}
+                    self.fault_response = None
+                body = json.dumps(obj).encode() if obj is not None else b""
+                self.send_response(code)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                if obj is not None:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with server.lock:
+                    server.status_counts[code] += 1
+
+            def read_body(self):
+                """Read the request body in chunks, returning (size, md5, first 1MB) so large uploads use bounded memory."""
+                h = hashlib.md5()
+                size = 0
+                head = b""
+                def consume(chunk):
+                    nonlocal size, head
+                    h.update(chunk)
+                    size += len(chunk)
+                    if len(head) < 1024*1024:
+                        head += chunk[:1024*1024 - len(head)]
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    while True:
+                        length = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                        if length == 0:
+                            self.rfile.readline()
+                            break
+                        consume(self.rfile.read(length))
+                        self.rfile.readline()
+                else:
+                    remaining = int(self.headers.get("Content-Length") or 0)
+                    while remaining:
+                        chunk = self.rfile.read(min(remaining, 1024*1024))
+                        if not chunk:
+                            break
+                        remaining -= len(chunk)
+                        consume(chunk)
+                with server.lock:
+                    server.bytes_received += size
+                return size, h.hexdigest(), head
+
+            def inject_failure(self):
+                """Returns True if an injected 429/503 was sent."""
+                with server.lock:
+                    now = time.time()
+                    if now - server.window_start >= 60:
+                        server.window_start = now
+                        server.window_count = 0
+                    server.window_count += 1
+                    over_limit = server.requests_per_minute and server.window_count > server.requests_per_minute
+                    reset = int(server.window_start + 60)
+                    roll = server.rng.random()
+                if over_limit:
+                    self.send_json(429, {"message": "Rate limit exceeded", "status": 429},
+                        {"X-RateLimit-Limit": str(server.requests_per_minute), "X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(reset)})
+                    return True
+                if roll < server.throttle_rate:
+                    self.send_json(429, {"message": "Too many requests", "status": 429}, {"Retry-After": str(server.retry_after)})
+                    return True
+                if roll < server.throttle_rate + server.error_rate:
+                    self.send_json(503, {"message": "Service unavailable", "status": 503})
+                    return True
+                return False
+
+            def handle_request(self, method):
+                start = time.monotonic()
+                path = urlparse(self.path).path
+                endpoint, handler = self.route(method, path)
+                if endpoint == "stats":
+                    return self.send_json(200, server.summary())
+                size, md5, body = self.read_body()
+                with server.lock:
+                    fault = server.faults[endpoint].pop(0) if server.faults[endpoint] else None
+                self.fault_response = None
+                try:
+                    if fault and fault.get("delay"):
+                        time.sleep(fault["delay"])
+                    if handler is None:
+                        self.send_json(404, {"message": "Not found", "status": 404})
+                    elif fault and fault.get("status") and not fault.get("processed"):
+                        self.send_json(fault["status"], {"message": "Injected fault", "status": fault["status"]}, fault.get("headers"))
+                    elif fault and fault.get("status"):
+                        self.fault_response = (fault["status"], fault.get("headers"))
+                        handler(size, md5, body)
+                    elif not self.inject_failure():
+                        if server.latency:
+                            time.sleep(server.rng.expovariate(1 / server.latency))
+                        handler(size, md5, body)
+                except KeyError:
+                    self.send_json(404, {"message": "Deposition not found", "status": 404})
+                with server.lock:
+                    server.stats[endpoint].append(time.monotonic() - start)
+
+            def route(self, method, path):
+                routes = [
+                    ("POST", r"/v1/graphql", "oa_graphql", self.graphql),
+                    ("GET", r"/_stats", "stats", None),
+                    ("POST", r"/api/deposit/depositions", "create", self.create),
+                    ("GET", r"/api/deposit/depositions/(\d+)", "get", self.get_deposition),
+                    ("PUT", r"/api/deposit/depositions/(\d+)", "update", self.update),
+                    ("GET", r"/api/deposit/depositions/(\d+)/files", "list_files", self.list_files),
+                    ("DELETE", r"/api/deposit/depositions/(\d+)/files/([^/]+)", "delete_file", self.delete_file),
+                    ("POST", r"/api/deposit/depositions/(\d+)/actions/publish", "publish", self.publish),
+                    ("POST", r"/api/deposit/depositions/(\d+)/actions/edit", "edit", self.edit),
+                    ("POST", r"/api/deposit/depositions/(\d+)/actions/newversion", "newversion", self.newversion),
+                    ("POST", r"/api/deposit/depositions/(\d+)/actions/discard", "discard", self.discard),
+                    ("PUT", r"/api/files/([^/]+)/(.+)", "upload", self.upload),
+                ]
+                for m, pattern, endpoint, handler in routes:
+                    match = re.fullmatch(pattern, path)
+                    if m == method and match:
+                        self.match = match
+                        return endpoint, handler
+                return "unknown", None
+
+            def graphql(self, size, md5, body):
+                query = json.loads(body)
+                variables = query.get("variables", {})
+                if query.get("operationName") == "FetchSubmissions":
+                    offset = variables.get("offset", 0)
+                    limit = variables.get("limit", len(server.submissions))
+                    data = {"id": variables.get("event_id"), "submissions": server.submissions[offset:offset+limit]}
+                else:
+                    data = {"program_dates": server.program_dates}
+                self.send_json(200, {"data": {"events_by_pk": data}})
+
+            def new_deposition(self, metadata, files):
+                # Must be called with server.lock held
+                zenodo_id = next(server.ids)
+                bucket = str(uuid.uuid4())
+                server.buckets[bucket] = zenodo_id
+                metadata["prereserve_doi"] = {"doi": f"10.5072/zenodo.{zenodo_id}", "recid": zenodo_id}
+                server.depositions[zenodo_id] = {
+                    "id": zenodo_id,
+                    "submitted": False,
+                    "state": "unsubmitted",
+                    "metadata": metadata,
+                    "files": files,
+                    "links": {"bucket": f"{server.url}api/files/{bucket}",
+                        "self": f"{server.url}api/deposit/depositions/{zenodo_id}"},
+                }
+                return server.depositions[zenodo_id]
+
+            def create(self, size, md5, body):
+                with server.lock:
+                    d = json.loads(json.dumps(self.new_deposition(json.loads(body).get("metadata", {}), [])))
+                self.send_json(201, d)
+
+            def get_deposition(self, size, md5, body):
+                with server.lock:
+                    d = json.loads(json.dumps(server._deposition(int(self.match.group(1)))))
+                self.send_json(200, d)
+
+            def update(self, size, md5, body):
+                with server.lock:
+                    d = server._deposition(int(self.match.group(1)))
+                    if d["state"] == "done":
+                        return self.send_json(400, {"message": "Published deposition must be edited first", "status": 400})
+                    doi = d["metadata"].get("prereserve_doi")
+                    d["metadata"] = json.loads(body).get("metadata", {})
+                    d["metadata"]["prereserve_doi"] = doi
+                    d = json.loads(json.dumps(d))
+                self.send_json(200, d)
+
+            def list_files(self, size, md5, body):
+                with server.lock:
+                    files = list(server._deposition(int(self.match.group(1)))["files"])
+                self.send_json(200, files)
+
+            def delete_file(self, size, md5, body):
+                with server.lock:
+                    d = server._deposition(int(self.match.group(1)))
+                    d["files"] = [f for f in d["files"] if f["id"] != self.match.group(2)]
+                self.send_json(204)
+
+            def publish(self, size, md5, body):
+                with server.lock:
+                    d = server._deposition(int(self.match.group(1)))
+                    d["submitted"] = True
+                    d["state"] = "done"
+                    d["doi"] = d["metadata"]["prereserve_doi"]["doi"]
+                    d = json.loads(json.dumps(d))
+                self.send_json(202, d)
+
+            def edit(self, size, md5, body):
+                with server.lock:
+                    d = server._deposition(int(self.match.group(1)))
+                    if d["state"] != "done":
+                        return self.send_json(400, {"message": "Deposition is not published", "status": 400})
+                    d["state"] = "inprogress"
+                    d = json.loads(json.dumps(d))
+                self.send_json(201, d)
+
+            def newversion(self, size, md5, body):
+                # The new version's draft starts with copies of the record's metadata and files
+                with server.lock:
+                    d = server._deposition(int(self.match.group(1)))
+                    if d["state"] != "done":
+                        return self.send_json(400, {"message": "Deposition is not published", "status": 400})
+                    files = [dict(f, id=str(uuid.uuid4())) for f in d["files"]]
+                    draft = self.new_deposition(json.loads(json.dumps(d["metadata"])), files)
+                    d["links"]["latest_draft"] = draft["links"]["self"]
+                    d = json.loads(json.dumps(d))
+                self.send_json(201, d)
+
+            def discard(self, size, md5, body):
+                # Discarding an edit publishes the record again (its metadata is not reverted)
+                with server.lock:
+                    d = server._deposition(int(self.match.group(1)))
+                    if not d["submitted"] or d["state"] == "done":
+                        return self.send_json(400, {"message": "Deposition is not being edited", "status": 400})
+                    d["state"] = "done"
+                    d = json.loads(json.dumps(d))
+                self.send_json(201, d)
+
+            def upload(self, size, md5, body):
+                name = unquote(self.match.group(2))
+                with server.lock:
+                    d = server._deposition(server.buckets[self.match.group(1)])
+                    if d["submitted"]:
+                        return self.send_json(403, {"message": "Record is published", "status": 403})
+                    d["files"] = [f for f in d["files"] if f["filename"] != name]
+                    d["files"].append({"id": str(uuid.uuid4()), "filename": name, "filesize": size, "checksum": md5})
+                self.send_json(201, {"key": name, "size": size, "checksum": f"md5:{md5}"})
+
+            def do_GET(self):
+                self.handle_request("GET")
+
+            def do_POST(self):
+                self.handle_request("POST")
+
+            def do_PUT(self):
+                self.handle_request("PUT")
+
+            def do_DELETE(self):
+                self.handle_request("DELETE")
+
+        return Handler
+
+def add_server_arguments(parser):
+    """Arguments shared with benchmark.py"""
+    parser.add_argument("--submissions", type=int, default=100, help="Number of accepted submissions in the synthetic event.")
+    parser.add_argument("--authors", type=int, default=3, help="Maximum authors per submission.")
+    parser.add_argument("--abstract-size", type=int, default=1000, help="Characters per abstract, controls OA payload size.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean seconds added to each response.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with 503.")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests failing with 429 and Retry-After.")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with throttled responses.")
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="Server-side rate limit, 0 disables.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic event and injected failures.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Oxford Abstracts and Zenodo APIs for oa2zenodo.py")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--upload-root", help="If provided, generate synthetic upload folders here.")
+    parser.add_argument("--files-per-submission", type=int, default=3, help="Maximum files per generated upload folder.")
+    parser.add_argument("--median-file-size", type=int, default=1024*1024, help="Median bytes of generated files.")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    submissions, program_dates = generate_event(args.submissions, args.authors, args.abstract_size, seed=args.seed)
+    if args.upload_root:
+        total = generate_files(args.upload_root, [s["serial_number"] for s in submissions],
+            args.files_per_submission, args.median_file_size, seed=args.seed)
+        print(f"Generated {total/(1024*1024):.1f} MB of upload files in '{args.upload_root}'")
+    server = MockServer(submissions, program_dates, port=args.port, latency=args.latency, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after, requests_per_minute=args.requests_per_minute, seed=args.seed)
+    print(f"Serving mock APIs at {server.url} (Oxford Abstracts: {server.url}v1/graphql)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
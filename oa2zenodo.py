@@ -1,46 +1,400 @@
-import requests, sys, configparser, csv, os, random, re
+"""
+Create Zenodo records for a conference managed on Oxford Abstracts.
+
+Importing this module has no side effects, the command line entry point is main().
+Each command only initialises what it needs, e.g. `index` never contacts Oxford Abstracts or Zenodo.
+"""
+import sys, configparser, csv, os, random, re, sqlite3, hashlib, threading, time, json, argparse, math, heapq
+import cProfile, pstats, tracemalloc
+from contextlib import contextmanager, ExitStack
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote
 from collections import defaultdict
-from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor, Future
+from fnmatch import translate
+from functools import cached_property
+
+COMMANDS = {
+    "run": "Plan and deposit the submissions of each event (the default if no command is given).",
+    "plan": "Plan every deposit (resolving any prompts), write the plan as JSON, and exit without writing to Zenodo.",
+    "upload": "Deposit a plan previously written by plan, without fetching from Oxford Abstracts or indexing upload folders.",
+    "fetch": "Fetch the programme and submissions of each event from Oxford Abstracts into the cache.",
+    "index": "Index the upload folders of each event.",
+}
+
+class Oa2ZenodoError(Exception):
+    """An error which stops the run, main() prints its message and exits with status 1."""
+
+class ConfigError(Oa2ZenodoError):
+    """A config file, or a plan, is missing or invalid."""
+
+class FetchError(Oa2ZenodoError):
+    """Data could not be fetched from Oxford Abstracts (or, offline, found in the cache)."""
+
+def parse_args(argv):
+    """Parse command line arguments. The command may be omitted, in which case it is run."""
+    command = "run"
+    if argv and argv[0] in COMMANDS:
+        command, argv = argv[0], argv[1:]
+    parser = argparse.ArgumentParser(prog=f"oa2zenodo.py {command}", description=COMMANDS[command],
+        epilog="Commands: " + ", ".join(COMMANDS))
+    parser.add_argument("conf_paths", nargs="*", default=["rsecon24.ini"], metavar="conf_path",
+        help="Config files, rsecon24.ini will be attempted if not provided. Multiple configs are processed as a single batch.")
+    parser.add_argument("--validate-config", action="store_true",
+        help="Check the config files and exit, without fetching from Oxford Abstracts or indexing upload folders.")
+    if command in ("run", "plan"):
+        parser.add_argument("--refresh", action="store_true",
+            help="Ignore cached Oxford Abstracts data, and fetch it again.")
+        parser.add_argument("--offline", action="store_true",
+            help="Use only cached Oxford Abstracts data regardless of age, implies a dry run.")
+        parser.add_argument("--plan-out", metavar="PLAN", required=command == "plan",
+            help="Plan every deposit (resolving any prompts), write the plan as JSON, and exit without writing to Zenodo.")
+    if command in ("run", "upload"):
+        parser.add_argument("--plan", metavar="PLAN", required=command == "upload",
+            help="Execute a plan previously written with --plan-out, rather than fetching from Oxford Abstracts.")
+        parser.add_argument("--sync", action="store_true",
+            help="Update records published by previous runs whose submission has since changed. "
+            "Changed metadata is edited in place, changed files are published as a new version.")
+    parser.add_argument("--profile", action="store_true",
+        help="Profile the run with cProfile, writing oa2zenodo.prof and printing the top functions.")
+    parser.add_argument("--tracemalloc", action="store_true",
+        help="Trace memory allocations, printing peak usage and the top allocation sites.")
+    args = parser.parse_args(argv)
+    args.command = command
+    # Options which the command doesn't accept take their defaults, fetch always fetches afresh
+    for option, default in (("refresh", command == "fetch"), ("offline", False), ("plan_out", None), ("plan", None), ("sync", False)):
+        if not hasattr(args, option):
+            setattr(args, option, default)
+    if args.refresh and args.offline:
+        parser.error("--refresh and --offline cannot be used together.")
+    if args.plan and (args.plan_out or args.refresh or args.offline):
+        parser.error("--plan cannot be used with --plan-out, --refresh or --offline.")
+    return args
 
-# Load config file
-if len(sys.argv) > 2:
-    print("Script requires a maximum of 1 argument, specifying the config file, %d were provided"%(len(sys.argv)-1))
-    print("rsecon24.ini will be attempted if an argument is not provided.")
-    sys.exit()
-    
-conf_path = "rsecon24.ini" if len(sys.argv)==1 else sys.argv[1]
-conf = configparser.ConfigParser()
-if os.path.exists(conf_path): 
-    with open(conf_path, "r") as conf_file: 
-        conf.read_file(conf_file) 
-else:
-    print(f"The config file '{conf_path}' was not found.")
-    sys.exit()
-
-# Validate config file has required sections/keys
 REQUIRED_SECTIONS = {'OXFORD_ABSTRACTS', 'ZENODO'}
-if not REQUIRED_SECTIONS.issubset(conf.sections()):
-    print("Config requires sections: %s"%(REQUIRED_SECTIONS))
-    sys.exit()
 REQUIRED_OA_KEYS = {'api_key', 'event_id'}
-if not REQUIRED_OA_KEYS.issubset(conf['OXFORD_ABSTRACTS'].keys()):
-    print("Config 'OXFORD_ABSTRACTS' section requires keys: %s"%(REQUIRED_OA_KEYS))
-    sys.exit()
 REQUIRED_Z_KEYS = {'api_key', 'use_sandbox', 'draft_only', 'keywords', 'community_identifiers', 'conference_title', 'conference_acronym', 'conference_dates', 'conference_place', 'conference_url'}
-if not REQUIRED_Z_KEYS.issubset(conf['ZENODO'].keys()):
-    print("Config 'ZENODO' section requires keys: %s"%(REQUIRED_Z_KEYS))
-    sys.exit()
+
+def load_event_confs(conf_paths):
+    """
+    Returns a list of (event name, config) for each event in the config files.
+    Each file is an event named after the file, plus an event for each [OXFORD_ABSTRACTS:<name>] section,
+    whose keys (and those of an optional [ZENODO:<name>] section) override the file's main sections.
+    Raises ConfigError if a file is missing, or lacks a required section or key.
+    """
+    event_confs = []
+    for conf_path in conf_paths:
+        conf = configparser.ConfigParser()
+        if os.path.exists(conf_path): 
+            with open(conf_path, "r") as conf_file: 
+                conf.read_file(conf_file) 
+        else:
+            raise ConfigError(f"The config file '{conf_path}' was not found.")
+        # Validate config file has required sections/keys
+        if not REQUIRED_SECTIONS.issubset(conf.sections()):
+            raise ConfigError(f"Config '{conf_path}' requires sections: %s"%(REQUIRED_SECTIONS))
+        event_names = [None] + [s.split(":", 1)[1] for s in conf.sections() if s.startswith("OXFORD_ABSTRACTS:")]
+        for event_name in event_names:
+            event_conf = configparser.ConfigParser()
+            for section in REQUIRED_SECTIONS:
+                event_conf[section] = dict(conf.items(section, raw=True))
+                if event_name and conf.has_section(f"{section}:{event_name}"):
+                    event_conf[section].update(conf.items(f"{section}:{event_name}", raw=True))
+            event_name = event_name or os.path.splitext(os.path.basename(conf_path))[0]
+            if not REQUIRED_OA_KEYS.issubset(event_conf['OXFORD_ABSTRACTS'].keys()):
+                raise ConfigError(f"Event '{event_name}' config 'OXFORD_ABSTRACTS' section requires keys: %s"%(REQUIRED_OA_KEYS))
+            if not REQUIRED_Z_KEYS.issubset(event_conf['ZENODO'].keys()):
+                raise ConfigError(f"Event '{event_name}' config 'ZENODO' section requires keys: %s"%(REQUIRED_Z_KEYS))
+            if event_name in [n for n, _ in event_confs]:
+                raise ConfigError(f"Event names must be unique, but '{event_name}' was found more than once.")
+            event_confs.append((event_name, event_conf))
+    return event_confs
+
+def percentile(values, p):
+    """Nearest-rank percentile, values must be sorted."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+class Metrics:
+    """
+    Timing spans of each stage of the run, written as JSON lines and summarised at the end of the run.
+    Spans are written to a temporary file which replaces path once the run completes, so an incomplete run
+    doesn't discard the previous run's metrics.
+    Stages: fetch, index, metadata, create, edit, newversion, fetch_draft, update, files, delete, upload, publish
+    """
+    def __init__(self, path, write=True):
+        self.lock = threading.Lock()
+        self.path = path
+        self.previous = self.load_previous(path)
+        self.file = open(f"{path}.tmp", "w", encoding="utf-8") if write else None
+        self.start = time.perf_counter()
+        self.stages = defaultdict(list) # stage: [seconds]
+        self.submissions = defaultdict(float) # (event name, submission id): total seconds
+        self.bytes_uploaded = 0
+        self.upload_seconds = 0.0
+
+    @staticmethod
+    def load_previous(path):
+        """
+        Returns (seconds per record excluding uploads, upload bytes per second) measured by a previous run's metrics,
+        or None if they are unavailable.
+        """
+        if not os.path.exists(path):
+            return None
+        record_seconds, records, upload_bytes, upload_seconds = 0.0, 0, 0, 0.0
+        with open(path, "r", encoding="utf-8") as metrics_file:
+            for line in metrics_file:
+                entry = json.loads(line)
+                if entry["stage"] == "upload" and entry["ok"]:
+                    upload_bytes += entry["bytes"]
+                    upload_seconds += entry["seconds"]
+                elif entry["stage"] in ("create", "fetch_draft", "delete", "publish"):
+                    record_seconds += entry["seconds"]
+                    records += entry["stage"] == "create"
+        if not records or not upload_seconds:
+            return None
+        return record_seconds / records, upload_bytes / upload_seconds
+
+    @contextmanager
+    def span(self, stage, submission=None, **fields):
+        """
+        Time the enclosed block. The yielded dict of fields may be updated within the block,
+        e.g. with the "status" of a response. Spans with a "bytes" field also record their throughput.
+        Spans of a submission should include an "event" field, as submission ids are only unique within an event.
+        """
+        start = time.perf_counter()
+        try:
+            yield fields
+            fields.setdefault("ok", fields.get("status", 200) // 100 == 2)
+        finally:
+            fields.setdefault("ok", False)
+            self.record(stage, submission, time.perf_counter() - start, fields)
+
+    def record(self, stage, submission, seconds, fields):
+        entry = {"time": time.time(), "stage": stage, "submission": submission, "seconds": seconds, **fields}
+        if "bytes" in fields:
+            entry["bytes_per_second"] = fields["bytes"] / seconds if seconds else 0.0
+        with self.lock:
+            self.stages[stage].append(seconds)
+            if submission is not None:
+                self.submissions[(fields.get("event"), submission)] += seconds
+            if stage == "upload" and fields["ok"]:
+                self.bytes_uploaded += fields["bytes"]
+                self.upload_seconds += seconds
+            if self.file:
+                self.file.write(json.dumps(entry) + "\n")
+
+    def summary(self, slowest=5):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                os.replace(self.file.name, self.path)
+                self.file = None
+            print(f"-----Run summary ({time.perf_counter() - self.start:.1f}s)-----")
+            print(f"{'stage':<12}{'count':>7}{'total s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+            for stage, durations in self.stages.items():
+                d = sorted(durations)
+                print(f"{stage:<12}{len(d):>7}{sum(d):>10.1f}{percentile(d, 50)*1000:>10.1f}{percentile(d, 90)*1000:>10.1f}"
+                    f"{percentile(d, 99)*1000:>10.1f}{d[-1]*1000:>10.1f}")
+            if self.bytes_uploaded:
+                print(f"Uploaded {self.bytes_uploaded/(1024*1024):.1f} MB, "
+                    f"{self.bytes_uploaded/(1024*1024)/self.upload_seconds:.2f} MB/s per upload on average")
+            if self.submissions:
+                # Submissions are only prefixed with their event in batches
+                batch = len(set(event for event, _ in self.submissions)) > 1
+                print("Slowest submissions: " + ", ".join(f"{event+' ' if batch else ''}#{sub_id} ({seconds:.1f}s)"
+                    for (event, sub_id), seconds in sorted(self.submissions.items(), key=lambda x: -x[1])[:slowest]))
+
+# Connect and read timeouts (seconds) for every API request
+REQUEST_TIMEOUT = (30, 600)
+# Exponential backoff between retries is capped to this many seconds
+RETRY_BACKOFF_MAX = 60
+# Responses which are worth retrying, 500 is only retried for idempotent methods
+RETRY_STATUSES = {429, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'PUT', 'DELETE', 'HEAD'}
+# Responses to requests which were certainly not processed, so non-idempotent methods (e.g. creating a deposition) can be retried
+# A timeout or 502/504 may follow a create which succeeded, retrying it would create a duplicate
+UNPROCESSED_STATUSES = {429, 503}
+
+def request_unsent(e):
+    """True if a requests exception was raised before the request reached the server, i.e. the connection was never established."""
+    import requests, urllib3
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    # requests wraps urllib3's MaxRetryError, whose reason is the underlying error
+    reason = e.args[0] if e.args else None
+    reason = getattr(reason, 'reason', reason)
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+class ApiClient:
+    """
+    Shared HTTP client for an API, built on a pooled requests.Session.
+    Failed requests (connection errors, 429 and 5xx) are retried with exponential backoff and jitter.
+    Non-idempotent requests (POST, unless idempotent=True) are only retried if they were certainly not processed,
+    i.e. the connection was never established or the response was 429 or 503.
+    Retry-After and X-RateLimit-* response headers pause all threads using the client,
+    and requests_per_minute (if non-zero) is enforced with a token bucket.
+    """
+    def __init__(self, pool_size=1, max_retries=5, requests_per_minute=0):
+        # requests is imported on first use, as it dominates the startup time of commands which make no requests
+        import requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.rate = requests_per_minute / 60
+        self.capacity = max(1, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def _wait(self):
+        # Block until the API is not paused and a token is available
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                elif not self.rate:
+                    return
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def _pause(self, seconds):
+        """Pause all threads using the client for seconds, returns False (without pausing) if seconds isn't positive."""
+        if seconds <= 0:
+            return False
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        return True
+
+    def _update_limits(self, r):
+        """
+        Pause the client if the response asks us to wait, returns True if it did.
+        A wait which has already elapsed doesn't pause, so the caller backs off instead of retrying immediately.
+        """
+        paused = False
+        # Retry-After may be either seconds or a HTTP date
+        retry_after = r.headers.get('Retry-After')
+        if retry_after and r.status_code in RETRY_STATUSES:
+            try:
+                paused = self._pause(float(retry_after))
+            except ValueError:
+                try:
+                    paused = self._pause(parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        # X-RateLimit-Reset is the epoch time at which the limit resets, truncated to whole seconds,
+        # so it may already have passed when the limit is exhausted: wait at least a second
+        remaining = r.headers.get('X-RateLimit-Remaining')
+        reset = r.headers.get('X-RateLimit-Reset')
+        if remaining and reset and int(remaining) <= 0:
+            paused = self._pause(max(1, int(reset) - time.time())) or paused
+        return paused
+
+    def _backoff(self, attempt):
+        # "Full jitter" exponential backoff
+        time.sleep(random.uniform(0, min(RETRY_BACKOFF_MAX, 2 ** attempt)))
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        import requests
+        kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        for attempt in range(self.max_retries + 1):
+            # Streamed bodies must be returned to the start before they can be resent
+            if attempt and hasattr(kwargs.get('data'), 'rewind'):
+                kwargs['data'].rewind()
+            self._wait()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # Requests which may have been processed are only retried if repeating them is harmless
+                if attempt == self.max_retries or not (idempotent or request_unsent(e)):
+                    raise
+                self._backoff(attempt)
+                continue
+            paused = self._update_limits(r)
+            if attempt < self.max_retries and (r.status_code in UNPROCESSED_STATUSES
+            or (idempotent and r.status_code in RETRY_STATUSES | {500})):
+                if not paused:
+                    self._backoff(attempt)
+                continue
+            return r
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+def fetch_oa(ev, query, description):
+    """
+    Perform a GraphQL query against an event's Oxford Abstracts API, returning the response's data.
+    The cache is used if it is younger than the event's cache_ttl (or --offline), and updated after a successful fetch.
+    The cache is keyed by event and a hash of the query, so editing a query invalidates it.
+    Raises FetchError if the query fails. Queries are run by the oa_executor, so this must not exit.
+    """
+    query_hash = hashlib.sha256(json.dumps([ev.oa_api, query], sort_keys=True).encode()).hexdigest()[:16]
+    cache_path = os.path.join(ev.oa_cache_dir, f"{query['variables']['event_id']}_{query['operationName']}_{query_hash}.json")
+    args = ev.batch.args
+    if os.path.exists(cache_path) and not args.refresh:
+        with open(cache_path, "r", encoding="utf-8") as cache_file:
+            cached = json.load(cache_file)
+        age = time.time() - cached["fetched"]
+        if args.offline or age < ev.oa_cache_ttl:
+            print(f"Using cached {description} data from Oxford Abstracts ({age:.0f}s old).")
+            return cached["data"]
+    if args.offline:
+        raise FetchError(f"Offline mode requires cached {description} data, but none was found at '{cache_path}'.")
+    with ev.batch.metrics.span("fetch", event=ev.name, query=query["operationName"], offset=query["variables"].get("offset")):
+        try:
+          # GraphQL queries are read-only, so they can be retried like a GET
+          r = ev.batch.oa_client.post(ev.oa_api,
+              headers={'x-api-key':ev.conf.get('OXFORD_ABSTRACTS', 'api_key')},
+              json=query,
+              idempotent=True
+              )
+          response = r.json()    
+        except Exception as e:
+              raise FetchError(f"An {type(e)} was thrown whilst fetching {description} data from Oxford Abstracts:\n{e}") from e
+        if "errors" in response:
+            raise FetchError(f"Failed to fetch {description} data from Oxford Abstracts:\n{response['errors'][0]['message']}")
+        if "data" not in response:
+            raise FetchError(f"Failed to fetch {description} data from Oxford Abstracts:\n{response.get('message', r.status_code)}")
+    # Write via a temporary file, so an interrupted write can't leave a corrupt cache
+    os.makedirs(ev.oa_cache_dir, exist_ok=True)
+    with open(cache_path + ".tmp", "w", encoding="utf-8") as cache_file:
+        json.dump({"fetched": time.time(), "data": response["data"]}, cache_file)
+    os.replace(cache_path + ".tmp", cache_path)
+    return response["data"]
 
 # Fetch submission info from OA
-# https://app.oxfordabstracts.com/new-graphql-api-key
-OXFORD_ABSTRACTS_API = "https://app.oxfordabstracts.com/v1/graphql"
 FETCH_SUBMISSIONS_QUERY = {  
   "query":"""
-query FetchSubmissions($event_id: Int!) {
+query FetchSubmissions($event_id: Int!, $limit: Int!, $offset: Int!) {
   events_by_pk(id: $event_id) {
     id
     submissions(
       where: {decision: {value: {_eq: "Accepted"}}, archived: {_eq: false}}
+      order_by: {id: asc}
+      limit: $limit
+      offset: $offset
     ) {
       decision {
         value
@@ -74,23 +428,30 @@ query FetchSubmissions($event_id: Int!) {
   }
 }
   """,
-  "variables": {"event_id": conf.get('OXFORD_ABSTRACTS', 'event_id')},
+  "variables": {}, # event_id, limit and offset are provided per request
   "operationName": "FetchSubmissions"
 }
-try:
-  r = requests.post(OXFORD_ABSTRACTS_API,
-      headers={'x-api-key':conf.get('OXFORD_ABSTRACTS', 'api_key')},
-      json=FETCH_SUBMISSIONS_QUERY
-      )
-  response = r.json()    
-  if "errors" in response:
-      print(f"Failed to fetch submission data from Oxford Abstracts:\n{response['errors'][0]['message']}")
-      sys.exit()
-except Exception as e:
-      print(f"An {type(e)} was thrown whilst fetching submission data from Oxford Abstracts:\n{e.message}")
-      sys.exit()
-
-oa_submissions = response["data"]["events_by_pk"]["submissions"]
+
+def fetch_oa_page(ev, offset):
+    """Fetch the page of an event's accepted submissions beginning at offset."""
+    query = dict(FETCH_SUBMISSIONS_QUERY, variables={"event_id": ev.event_id, "limit": ev.oa_page_size, "offset": offset})
+    return fetch_oa(ev, query, f"submission (page {offset//ev.oa_page_size + 1})")["events_by_pk"]["submissions"]
+
+def fetch_oa_submissions(ev):
+    """
+    Yield an event's accepted submissions in ascending ID order, fetching them a page at a time.
+    Each page is requested in the background as soon as the previous page has arrived,
+    so deposits of earlier submissions proceed whilst later pages download.
+    """
+    offset = 0
+    page = ev.first_page or ev.batch.oa_executor.submit(fetch_oa_page, ev, offset)
+    while page:
+        submissions = page.result()
+        page = None
+        if len(submissions) == ev.oa_page_size:
+            offset += ev.oa_page_size
+            page = ev.batch.oa_executor.submit(fetch_oa_page, ev, offset)
+        yield from submissions
 
 FETCH_PROGRAMME_QUERY = {  
   "query":"""
@@ -104,6 +465,11 @@ query FetchProgramme($event_id: Int!) {
             title {
               without_html
             }
+            serial_number
+            archived
+            decision {
+              value
+            }
           }
           submission_id
         }
@@ -121,26 +487,14 @@ query FetchProgramme($event_id: Int!) {
   }
 }
 """,
-  "variables": {"event_id": conf.get('OXFORD_ABSTRACTS', 'event_id')},
+  "variables": {}, # event_id is provided per request
   "operationName": "FetchProgramme"
 }
-try:
-  r = requests.post(OXFORD_ABSTRACTS_API,
-      headers={'x-api-key':conf.get('OXFORD_ABSTRACTS', 'api_key')},
-      json=FETCH_PROGRAMME_QUERY
-      )
-  response = r.json()    
-  if "errors" in response:
-      print(f"Failed to fetch programme data from Oxford Abstracts:\n{response['errors'][0]['message']}")
-      sys.exit()
-except Exception as e:
-      print(f"An {type(e)} was thrown whilst fetching programme data from Oxford Abstracts:\n{e.message}")
-      sys.exit()
-
-oa_programme_dates_raw = response["data"]["events_by_pk"]["program_dates"]
 
 # Process raw graphql response into a cleaner format
 class ProgrammeItem:
+    __slots__ = ("date", "start_time", "end_time", "session_name", "track_name")
+
     def __init__(self, date, start_time, end_time, session_name, track_name):
         self.date = date # do we want to parse this to a proper object?
         self.start_time = start_time # do we want to parse this to a proper object?
@@ -151,45 +505,27 @@ class ProgrammeItem:
     def __str__(self):
         return f"Prog(Date:{self.date}, Time:{self.start_time}-{self.end_time}, Session: {self.session_name}, Track: {self.track_name})"
 
-oa_programme_submissions = defaultdict(list)
-oa_programme_plenary = [] # Not strictly plenary, sessions without a submission or column
-for programme_date in oa_programme_dates_raw:
-    date = programme_date["program_date"]
-    for programme_session in programme_date["program_sessions"]:
-        # If there is no column it's a plenary session
-        if len(programme_session["program_sessions_program_columns"]) + len(programme_session["program_sessions_submissions"]) == 0:
-            oa_programme_plenary.append(ProgrammeItem(
-                date,
-                programme_session["start_time"],
-                programme_session["end_time"],
-                programme_session["name"],
-                "Plenary"))
-        else:
-            for programme_submission in programme_session["program_sessions_submissions"]:
-                t = programme_session["program_sessions_program_columns"]
-                track = t[0]["program_column"]["name"] if len(t) else "Plenary"
-                oa_programme_submissions[programme_submission["submission_id"]].append(ProgrammeItem(
-                    date,
-                    programme_session["start_time"],
-                    programme_session["end_time"],
-                    programme_session["name"],
-                    track))
-
-#print("-----Programme Plenary Info-----")
-#for a in oa_programme_plenary:
-#  print(a)
-
-#print("-----Programme Submission Info-----")
-#for a,b in oa_programme_submissions.items():
-#  for t in b:
-#    print("%s: %s"%(a, t))
-
 class Author:
-  first=""
-  last=""
-  orcid=None
-  institutions=[]
-  
+    __slots__ = ("first", "last", "orcid", "institutions")
+
+    def __init__(self, oa_author):
+        self.first = oa_author["first_name"]
+        self.last = oa_author["last_name"]
+        self.orcid = oa_author["orcid_id"]
+        self.institutions = [a["institution"] for a in oa_author["affiliations"]]
+
+    def to_creator(self):
+        """Zenodo creator representation"""
+        a = {
+            "type": "ProjectMember", # Required field with controlled vocab, which we aren't collecting
+            "name": f"{self.last}, {self.first}",
+        }
+        if self.institutions:
+            a["affiliation"] = ", ".join(self.institutions)
+        if self.orcid:
+            a["orcid"] = self.orcid
+        return a
+
 def accepted_for_to_upload_type(af):
     if af=="Poster & Lightning Talk":
         return "poster"
@@ -200,100 +536,957 @@ def accepted_for_to_upload_type(af):
     else: # Hackathon, Birds of a Feather
         return "other"
 
-ZENODO_API = "https://sandbox.zenodo.org/" if conf.getboolean('ZENODO', 'use_sandbox') else "https://zenodo.org/"
-# Setup the target Zenodo communities in the correct format
-ZENODO_COMMUNITIES = []
-for comm in conf.get('ZENODO', 'community_identifiers').split():
-    ZENODO_COMMUNITIES.append({"identifier":comm})
-ZENODO_KEYWORDS = conf.get('ZENODO', 'keywords').split()
-
-skipped_sessions = set()
-
-# Locate fake file if requested
-fake_file_path = ""
-if conf.getboolean('ZENODO', 'fake_upload') and conf.getboolean('ZENODO', 'use_sandbox'):
-    fake_file = None
-    while not fake_file:
-        fake_file_path = input("Specify location of fake file to use for Sandbox uploads: ")
-        fake_file = open(fake_file_path, 'rb')
-    del fake_file
-elif conf.getboolean('ZENODO', 'fake_upload'):
-    print("Error: fake_upload=TRUE is not compatible with use_sandbox=FALSE.")
-    sys.exit()
-
-# Process skipped submissions into a set of integers
-SKIPPED_SUBMISSIONS = set()
-if 'skipped_submissions' in conf['ZENODO']:
-    SKIPPED_SUBMISSIONS = set([int(i) for i in conf['ZENODO']['skipped_submissions'].split()])
-
-# Build a map of id:upload-folder-path (because GLOB sucks)
-UPLOAD_DIRS = {}
-for root, dirs, files in os.walk(conf['ZENODO']['file_search_root']):
-    for dir in dirs:
-        m = re.search("^ID ?([0-9]+)",dir)
-        if m:
-            if int(m.group(1)) in UPLOAD_DIRS:
-                raise Exception(f"2 dirs for submission {m.group(1)}\n{UPLOAD_DIRS[int(m.group(1))]}\n{os.path.join(root, dir)}")
-            UPLOAD_DIRS[int(m.group(1))] = os.path.join(root, dir)
-
-# Build a map of id:youtube-url
-YOUTUBE_URLS = {}
-if "youtube_csv" in conf['ZENODO']:
-    if not ("youtube_csv_id" in conf['ZENODO'] and "youtube_csv_url" in  conf['ZENODO']):
-        raise Exception("Input contains 'youtube_csv', but not both 'youtube_csv_id' and 'youtube_csv_url' which denote column headings")
-    with open(conf['ZENODO']['youtube_csv'], mode='r', newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        key = conf['ZENODO']['youtube_csv_id']
-        val = conf['ZENODO']['youtube_csv_url']
-        for row in reader:
-            # Only use rows that have data
-            if len(row[key]) and len(row[val]):
+class FileIndex:
+    """
+    Persistent index of the directory listings beneath each event's file_search_root.
+    Listing directories on Google Drive filestream is slow, so a cached listing is reused
+    whenever its directory's mtime is unchanged (a directory's mtime changes when entries are added/removed/renamed).
+    The search for upload folders stops descending at each "ID nnn" folder, their contents are listed on demand.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirs = {} # dir path: {"mtime": ns, "dirs": [names], "files": {name: [size, mtime ns]}}
+        self.upload_dirs = {} # search root: {submission id: dir path}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as index_file:
+                self.dirs = json.load(index_file)["dirs"]
+        self.visited = set()
+
+    def listing(self, path):
+        """Returns the listing of a directory, only reading it if it has changed since it was indexed."""
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            entry = self.dirs.get(path)
+        if not entry or entry["mtime"] != mtime:
+            entry = {"mtime": mtime, "dirs": [], "files": {}}
+            with os.scandir(path) as it:
+                for e in it:
+                    if e.is_dir():
+                        entry["dirs"].append(e.name)
+                    elif e.is_file():
+                        st = e.stat()
+                        entry["files"][e.name] = [st.st_size, st.st_mtime_ns]
+        with self.lock:
+            self.dirs[path] = entry
+            self.visited.add(path)
+        return entry
+
+    def find_upload_dirs(self, root):
+        """
+        Returns the map of submission id:upload-folder-path beneath root (because GLOB sucks).
+        Each root is only searched once per run, so events sharing a root share the search.
+        The map isn't saved, as checking it is current requires the same stat of every searched directory
+        (a new ID folder only changes its parent's mtime), and the search reuses their unchanged listings.
+        """
+        if root not in self.upload_dirs:
+            self.upload_dirs[root] = {}
+            self._find_upload_dirs(root, self.upload_dirs[root])
+            self.save()
+        return self.upload_dirs[root]
+
+    def _find_upload_dirs(self, path, upload_dirs):
+        for d in self.listing(path)["dirs"]:
+            child = os.path.join(path, d)
+            m = re.search("^ID ?([0-9]+)", d)
+            if m:
+                if int(m.group(1)) in upload_dirs:
+                    raise Exception(f"2 dirs for submission {m.group(1)}\n{upload_dirs[int(m.group(1))]}\n{child}")
+                upload_dirs[int(m.group(1))] = child
+            else:
+                self._find_upload_dirs(child, upload_dirs)
+
+    def walk(self, path, prune=None):
+        """Equivalent of os.walk(path), using the index. Subdirectories whose name matches prune are not descended."""
+        entry = self.listing(path)
+        dirs = [d for d in entry["dirs"] if not (prune and prune(d))]
+        yield path, dirs, list(entry["files"])
+        for d in dirs:
+            yield from self.walk(os.path.join(path, d), prune)
+
+    def save(self):
+        # Listings which were not visited this run are kept only if they are within an upload folder
+        upload_dirs = tuple(os.path.join(d, "") for root_dirs in self.upload_dirs.values() for d in root_dirs.values())
+        with self.lock:
+            dirs = {p: e for p, e in self.dirs.items()
+                if p in self.visited or os.path.join(p, "").startswith(upload_dirs)}
+        with open(self.path + ".tmp", "w", encoding="utf-8") as index_file:
+            json.dump({"dirs": dirs}, index_file)
+        os.replace(self.path + ".tmp", self.path)
+
+class NameMatcher:
+    """
+    Case-insensitive matcher for a list of glob style (fnmatch) patterns, compiled once.
+    Literal names and patterns of the form "*<literal>" (e.g. "*.gdoc") are matched with set lookup/str.endswith,
+    any other patterns are combined into a single regular expression.
+    """
+    def __init__(self, patterns):
+        self.names = set()
+        suffixes = []
+        complex_patterns = []
+        for p in patterns:
+            p = p.lower()
+            if not any(c in p for c in "*?["):
+                self.names.add(p)
+            elif p.startswith("*") and not any(c in p[1:] for c in "*?["):
+                suffixes.append(p[1:])
+            else:
+                complex_patterns.append(translate(p))
+        self.suffixes = tuple(suffixes)
+        self.regex = re.compile("|".join(complex_patterns), re.IGNORECASE) if complex_patterns else None
+        self.empty = not patterns
+
+    def match(self, name):
+        name = name.lower()
+        return (name in self.names
+            or (bool(self.suffixes) and name.endswith(self.suffixes))
+            or (self.regex is not None and self.regex.match(name) is not None))
+
+def conf_patterns(conf, key):
+    return conf['ZENODO'][key].split() if key in conf['ZENODO'] else []
+
+class StateStore:
+    """
+    Durable record of the progress of each submission, so that an interrupted run can be resumed
+    without creating duplicate depositions. Entries are keyed by Zenodo host, OA event and OA serial number.
+    The hash of the metadata and the size, mtime and checksum of each file sent to Zenodo are also recorded,
+    so that --sync can find changed submissions without contacting Zenodo.
+    A record's version is recorded once --sync has published a new version of it, otherwise the plan's version is used.
+    """
+    connections = {} # path: (connection, lock), events with the same state_db share its connection
+    connections_lock = threading.Lock()
+
+    def __init__(self, path, api, event_id):
+        self.api = api
+        self.event_id = str(event_id)
+        # Events may share a state_db, and construct their StateStore from worker threads
+        with StateStore.connections_lock:
+            if path not in StateStore.connections:
+                db = sqlite3.connect(path, check_same_thread=False)
+                with db:
+                    db.execute("""CREATE TABLE IF NOT EXISTS depositions (
+                        api TEXT, event_id TEXT, submission_id INTEGER,
+                        zenodo_id INTEGER, doi TEXT, published INTEGER DEFAULT 0, metadata_hash TEXT, version TEXT,
+                        PRIMARY KEY (api, event_id, submission_id))""")
+                    db.execute("""CREATE TABLE IF NOT EXISTS files (
+                        api TEXT, event_id TEXT, submission_id INTEGER,
+                        name TEXT, size INTEGER, checksum TEXT, mtime INTEGER,
+                        PRIMARY KEY (api, event_id, submission_id, name))""")
+                    # Add columns missing from state files created by older versions
+                    for table, column in (("depositions", "metadata_hash TEXT"), ("depositions", "version TEXT"), ("files", "mtime INTEGER")):
+                        if column.split()[0] not in [row[1] for row in db.execute(f"PRAGMA table_info({table})")]:
+                            db.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+                StateStore.connections[path] = (db, threading.Lock())
+            self.db, self.lock = StateStore.connections[path]
+
+    def get(self, sub_id):
+        """Returns (zenodo_id, doi, published) or None if a draft has not been created."""
+        with self.lock:
+            row = self.db.execute("SELECT zenodo_id, doi, published FROM depositions WHERE api=? AND event_id=? AND submission_id=?",
+                (self.api, self.event_id, sub_id)).fetchone()
+        return (row[0], row[1], bool(row[2])) if row else None
+
+    def metadata_hash(self, sub_id):
+        """Returns the hash of the metadata last sent to Zenodo, or None if it was not recorded."""
+        with self.lock:
+            row = self.db.execute("SELECT metadata_hash FROM depositions WHERE api=? AND event_id=? AND submission_id=?",
+                (self.api, self.event_id, sub_id)).fetchone()
+        return row[0] if row else None
+
+    def version(self, sub_id):
+        """Returns the record's version, None if it is the plan's version, or empty if it has none."""
+        with self.lock:
+            row = self.db.execute("SELECT version FROM depositions WHERE api=? AND event_id=? AND submission_id=?",
+                (self.api, self.event_id, sub_id)).fetchone()
+        return row[0] if row else None
+
+    def files(self, sub_id):
+        """Returns {name: (size, mtime, checksum)} of the files uploaded to the submission's deposition."""
+        with self.lock:
+            rows = self.db.execute("SELECT name, size, mtime, checksum FROM files WHERE api=? AND event_id=? AND submission_id=?",
+                (self.api, self.event_id, sub_id)).fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def draft_created(self, sub_id, zenodo_id, doi, metadata_hash):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO depositions (api, event_id, submission_id, zenodo_id, doi, published, metadata_hash) VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (self.api, self.event_id, sub_id, zenodo_id, doi, metadata_hash))
+
+    def reopened(self, sub_id, zenodo_id, doi):
+        """A published record is being edited, or has a new version draft (with a new ID and DOI)."""
+        with self.lock, self.db:
+            self.db.execute("UPDATE depositions SET zenodo_id=?, doi=?, published=0 WHERE api=? AND event_id=? AND submission_id=?",
+                (zenodo_id, doi, self.api, self.event_id, sub_id))
+
+    def new_version(self, sub_id, zenodo_id, version):
+        """
+        A published record has a new version draft, with a new ID (and DOI, which is read from the draft).
+        The metadata hash is cleared, so that the draft's metadata (copied from the previous version) is updated with the new version.
+        """
+        with self.lock, self.db:
+            self.db.execute("UPDATE depositions SET zenodo_id=?, doi='', published=0, version=?, metadata_hash=NULL WHERE api=? AND event_id=? AND submission_id=?",
+                (zenodo_id, version, self.api, self.event_id, sub_id))
+
+    def metadata_updated(self, sub_id, metadata_hash):
+        with self.lock, self.db:
+            self.db.execute("UPDATE depositions SET metadata_hash=? WHERE api=? AND event_id=? AND submission_id=?",
+                (metadata_hash, self.api, self.event_id, sub_id))
+
+    def file_uploaded(self, sub_id, name, size, checksum, mtime):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO files (api, event_id, submission_id, name, size, checksum, mtime) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.api, self.event_id, sub_id, name, size, checksum, mtime))
+
+    def file_deleted(self, sub_id, name):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files WHERE api=? AND event_id=? AND submission_id=? AND name=?",
+                (self.api, self.event_id, sub_id, name))
+
+    def published(self, sub_id):
+        with self.lock, self.db:
+            self.db.execute("UPDATE depositions SET published=1 WHERE api=? AND event_id=? AND submission_id=?",
+                (self.api, self.event_id, sub_id))
+
+def md5sum(path, chunk_size=1024*1024):
+    """Hash a file in chunks, so large files are never read fully into memory."""
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def metadata_hash(metadata):
+    return hashlib.sha256(json.dumps(metadata, sort_keys=True).encode()).hexdigest()
+
+def next_version(version):
+    """The version of a record's new version, e.g. 1.0.0 becomes 1.1.0. None if version isn't numeric."""
+    parts = str(version or "").split(".")
+    if len(parts) < 2 or not all(part.isdigit() for part in parts):
+        return None
+    return ".".join(parts[:1] + [str(int(parts[1]) + 1)] + ["0"] * (len(parts) - 2))
+
+def record_metadata(ev, sub_id, metadata):
+    """The metadata to send for a planned submission, with its record's version if --sync has published a new version."""
+    version = ev.state.version(sub_id)
+    if version is None:
+        return metadata
+    # An empty version is a new version of a record whose version wasn't numeric, so it has none
+    return dict(metadata, version=version) if version else {k: v for k, v in metadata.items() if k != "version"}
+
+def deposition_id(url):
+    """The ID of the deposition at a deposition API url, e.g. links.latest_draft."""
+    return int(url.rstrip("/").split("/")[-1])
+
+def record_changes(ev, sub):
+    """
+    Compare a planned submission against the state store's record of what was last sent to Zenodo.
+    Returns (metadata changed, files changed). Local files are only hashed if their size matches but their mtime differs.
+    Files are stat'd afresh, as the upload folder index doesn't notice files modified in place.
+    """
+    sub_id = sub["id"]
+    metadata_changed = ev.state.metadata_hash(sub_id) != metadata_hash(sub["metadata"])
+    recorded = ev.state.files(sub_id)
+    if set(recorded) != set(f["name"] for f in sub["files"]):
+        return metadata_changed, True
+    for f in sub["files"]:
+        size, mtime, checksum = recorded[f["name"]]
+        try:
+            st = os.stat(f["path"])
+            if st.st_size != size:
+                return metadata_changed, True
+            if st.st_mtime_ns != mtime:
+                if md5sum(f["path"]) != checksum:
+                    return metadata_changed, True
+                # Only touched, so record the new mtime to avoid hashing it again
+                ev.state.file_uploaded(sub_id, f["name"], size, checksum, st.st_mtime_ns)
+        except OSError:
+            # The file has gone since it was planned, the upload will log why
+            return metadata_changed, True
+    return metadata_changed, False
+
+# Minimum seconds between progress reports for a single file upload
+UPLOAD_PROGRESS_INTERVAL = 10
+
+class UploadReader:
+    """
+    File-like wrapper used as a streamed request body.
+    Reads the file chunk_size bytes at a time, and periodically reports progress and throughput.
+    Each chunk is passed through the scheduler, which enforces the bandwidth budget and tracks the ETA.
+    """
+    def __init__(self, file, size, label, chunk_size, scheduler):
+        self.file = file
+        self.size = size
+        self.label = label
+        self.chunk_size = chunk_size
+        self.scheduler = scheduler
+        self.sent = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    def rewind(self):
+        # Called by ApiClient before a retry
+        self.file.seek(0)
+        self.scheduler.rewound(self.sent)
+        self.sent = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    def __len__(self):
+        # Allows requests to set Content-Length, rather than using chunked transfer encoding
+        return self.size
+
+    def read(self, n=-1):
+        # The requested size (http.client's small default block size) is ignored in favour of the configured chunk size
+        chunk = self.file.read(self.chunk_size)
+        self.sent += len(chunk)
+        self.scheduler.sent(len(chunk))
+        if time.monotonic() - self.last_report >= UPLOAD_PROGRESS_INTERVAL:
+            self.report()
+        return chunk
+
+    def report(self, final=False):
+        self.last_report = time.monotonic()
+        elapsed = max(self.last_report - self.start, 1e-6)
+        rate = self.sent / elapsed / (1024*1024)
+        if final:
+            print(f"Uploaded {self.label}: {self.sent/(1024*1024):.1f} MB in {elapsed:.1f}s ({rate:.2f} MB/s)")
+        else:
+            print(f"Uploading {self.label}: {100*self.sent/max(self.size, 1):.0f}% ({rate:.2f} MB/s)")
+
+# Orders in which pending file uploads are started, by the priority of a file of the given size
+UPLOAD_ORDERS = {
+    "plan": lambda size: 0, # The order files were planned (directory walk order)
+    "smallest": lambda size: size, # Finishes records sooner
+    "largest": lambda size: -size, # Minimises the total time, as the largest files are not left until last
+}
+
+class UploadTask:
+    """A file upload queued by the UploadScheduler."""
+    __slots__ = ("priority", "sequence", "deposition", "size", "sent", "future", "fn", "fn_args")
+
+    def __init__(self, priority, sequence, deposition, size, future, fn, fn_args):
+        self.priority = priority
+        self.sequence = sequence
+        self.deposition = deposition
+        self.size = size
+        self.sent = 0
+        self.future = future
+        self.fn = fn
+        self.fn_args = fn_args
+
+    def __lt__(self, other):
+        # Ties retain submission order
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+class UploadScheduler:
+    """
+    Shared pool of threads which upload the files of every deposition in flight.
+    Pending uploads are started in upload_order, but no deposition has more than file_workers uploads at once.
+    The bytes sent by all uploads share a budget of bytes_per_second (if non-zero), enforced with a token bucket.
+    The bytes remaining of each dispatched deposition are tracked, to report an ETA from the measured throughput.
+    """
+    def __init__(self, threads, file_workers, order="plan", bytes_per_second=0):
+        self.file_workers = file_workers
+        self.priority = UPLOAD_ORDERS[order]
+        self.condition = threading.Condition()
+        self.pending = [] # heap of UploadTask
+        self.active = defaultdict(int) # deposition: uploads in progress
+        self.sequence = 0
+        self.closed = False
+        self.current = threading.local() # Task being executed by each thread
+        # Bandwidth budget, up to a second's worth of bytes may be sent in a burst
+        self.lock = threading.Lock()
+        self.rate = bytes_per_second
+        self.tokens = self.rate
+        self.updated = time.monotonic()
+        # Progress, for the ETA
+        self.remaining = defaultdict(int) # deposition: planned bytes not yet uploaded
+        self.in_flight = 0 # bytes sent by uploads in progress
+        self.bytes_sent = 0
+        self.first_sent = None
+        self.last_report = time.monotonic()
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def expect(self, deposition, size):
+        """Include a dispatched deposition's planned bytes in the ETA, before its files are submitted."""
+        with self.lock:
+            self.remaining[deposition] += size
+
+    def finished(self, deposition):
+        """A deposition has completed, so any of its bytes which were not uploaded (e.g. unchanged files) are no longer expected."""
+        with self.lock:
+            self.remaining.pop(deposition, None)
+
+    def submit(self, deposition, size, fn, *fn_args):
+        """Queue the upload of a deposition's file of the given size, returning the future of fn(*fn_args)."""
+        future = Future()
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.pending, UploadTask(self.priority(size), self.sequence, deposition, size, future, fn, fn_args))
+            self.condition.notify()
+        return future
+
+    def _next(self):
+        # Pop the highest priority task whose deposition has a free slot, must be called holding the condition
+        skipped = []
+        task = None
+        while self.pending:
+            candidate = heapq.heappop(self.pending)
+            if self.active[candidate.deposition] < self.file_workers:
+                task = candidate
+                break
+            skipped.append(candidate)
+        for candidate in skipped:
+            heapq.heappush(self.pending, candidate)
+        return task
+
+    def _run(self):
+        while True:
+            with self.condition:
+                task = self._next()
+                while not task:
+                    if self.closed and not self.pending:
+                        return
+                    self.condition.wait()
+                    task = self._next()
+                self.active[task.deposition] += 1
+            if task.future.set_running_or_notify_cancel():
+                self.current.task = task
                 try:
-                    # Regular 1:1 matches
-                    YOUTUBE_URLS[int(row[key])] = row[val]
-                except ValueError:
-                    i = row[key].split(",")
-                    for j in i:
-                        # N:1 matches (Poster lighting talks)
-                        YOUTUBE_URLS[int(j)] = row[val]
-
-FILE_BLACKLIST = conf['ZENODO']['file_blacklist'].split() if 'file_blacklist' in conf['ZENODO'] else []
-
-# Create output file to log progress of records
-with open('oa2zenodo_log.csv', 'w', newline='') as logfile:
-    log = csv.writer(logfile, dialect='excel')
-    # Write header
-    log.writerow(['submission_id', 'submission_title', 'zenodo_id', 'doi', 'status'])    
-    # Process submissions
-    for submission in oa_submissions:
-        zenodo_id = ''
-        zenodo_doi = ''
-        sub_global_id = submission["id"] # This is a globally unique ID
-        sub_id = submission["serial_number"] # This is ID from within OA website
-        sub_title = submission["title"][0]["without_html"]
-        sub_abstract = "" # Zenodo permits HTML
-        sub_approve_upload = False
-        sub_authors = []
-        sub_type = accepted_for_to_upload_type(submission["accepted_for"]["value"])
-        sub_has_permission = False
-        sub_conference_session = None
-        if sub_id in SKIPPED_SUBMISSIONS:
-            log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, f"Skipped as requested by config"])
-            continue
-        # Locate session info
-        if sub_global_id in oa_programme_submissions:
-            # Filter out duplicate and previously skipped session names
-            matching_sessions = []
-            for x in oa_programme_submissions[sub_global_id]:
-                if (x.session_name not in matching_sessions
-                and x.session_name not in skipped_sessions):
-                    matching_sessions.append(x.session_name)
+                    task.future.set_result(task.fn(*task.fn_args))
+                except BaseException as e:
+                    task.future.set_exception(e)
+                finally:
+                    self.current.task = None
+            with self.lock:
+                self.in_flight -= task.sent
+                if task.deposition in self.remaining:
+                    self.remaining[task.deposition] -= task.size
+            with self.condition:
+                self.active[task.deposition] -= 1
+                if not self.active[task.deposition]:
+                    del self.active[task.deposition]
+                # A slot has been freed, which may make a pending upload of the same deposition eligible
+                self.condition.notify_all()
+
+    def sent(self, n):
+        """Account for n bytes sent by the calling upload thread, blocking whilst the bandwidth budget is exhausted."""
+        task = getattr(self.current, "task", None)
+        with self.lock:
+            now = time.monotonic()
+            if self.first_sent is None:
+                self.first_sent = now
+            self.bytes_sent += n
+            if task:
+                task.sent += n
+                self.in_flight += n
+            delay = 0
+            if self.rate:
+                # Tokens may go negative, the debt is repaid by sleeping, so concurrent uploads share the budget
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - n
+                self.updated = now
+                if self.tokens < 0:
+                    delay = -self.tokens / self.rate
+            report = now - self.last_report >= UPLOAD_PROGRESS_INTERVAL
+            if report:
+                self.last_report = now
+        if report:
+            self.report()
+        if delay:
+            time.sleep(delay)
+
+    def rewound(self, n):
+        """An upload is being retried, so the n bytes it had sent will be sent again."""
+        task = getattr(self.current, "task", None)
+        if task:
+            with self.lock:
+                task.sent -= n
+                self.in_flight -= n
+
+    def eta(self):
+        """Returns (bytes remaining, measured bytes per second, seconds remaining), or None before any bytes are sent."""
+        with self.lock:
+            if not self.bytes_sent:
+                return None
+            remaining = max(0, sum(self.remaining.values()) - self.in_flight)
+            rate = self.bytes_sent / max(time.monotonic() - self.first_sent, 1e-6)
+        return remaining, rate, remaining / rate
+
+    def report(self):
+        eta = self.eta()
+        if eta:
+            remaining, rate, seconds = eta
+            print(f"-----Uploads: {self.bytes_sent/(1024*1024):.1f} MB sent at {rate/(1024*1024):.2f} MB/s, "
+                f"{remaining/(1024*1024):.1f} MB remaining, ETA {seconds/60:.1f} minutes-----")
+
+    def shutdown(self):
+        """Stop the threads once every queued upload has completed."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+def delete_deposition_file(ev, zenodo_id, ef, rows, sub_id, sub_title, zenodo_doi):
+    """
+    Delete a file (as listed by Zenodo) from a draft deposition.
+    Failures are appended to rows, returns True on success.
+    """
+    try:
+        with ev.batch.metrics.span("delete", sub_id, event=ev.name) as span:
+            r = ev.batch.zenodo_client.delete(ev.zenodo_api+f"api/deposit/depositions/{zenodo_id}/files/{ef['id']}",
+                params={'access_token': ev.conf.get('ZENODO', 'api_key')})
+            span["status"] = r.status_code
+        if r.status_code // 100 != 2:
+            rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Deleting stale file '{ef['filename']}' from Zenodo returned error: {r.json()['message']}"])
+            return False
+    except Exception as e:
+        rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Deleting stale file '{ef['filename']}' from Zenodo failed: {e}"])
+        return False
+    ev.state.file_deleted(sub_id, ef['filename'])
+    return True
+
+def upload_file(ev, sf, ef, recorded, sub_id, sub_title, zenodo_id, zenodo_doi, zenodo_bucket):
+    """
+    Upload a file to a deposition's bucket, unless ef (the existing file of the same name, as listed by Zenodo) is identical.
+    recorded is the state store's (size, mtime, checksum) of the file when it was last uploaded, if any.
+    This is executed by the upload pool, concurrently with the deposition's other files.
+    Returns the list of log rows produced, which is only non-empty if the upload failed.
+    """
+    rows = []
+    if ev.conf.getboolean('ZENODO', 'dry_run'):
+        print(f"[DRY] Uploaded '{sf}' for submission {ev.sub_label(sub_id)}")
+        return rows
+    sf_name = os.path.basename(sf)
+    try:
+        st = os.stat(sf)
+        sf_size = st.st_size
+        sf_checksum = None
+        if ef:
+            # Only hash the local file if the size matches, a different size has changed regardless
+            if ef["filesize"] == sf_size:
+                # Nor if it is unmodified since it was uploaded
+                if recorded == (sf_size, st.st_mtime_ns, ef["checksum"]):
+                    return rows
+                sf_checksum = md5sum(sf)
+                if ef["checksum"] == sf_checksum:
+                    ev.state.file_uploaded(sub_id, sf_name, sf_size, sf_checksum, st.st_mtime_ns)
+                    return rows
+            # The file has changed, so the old copy must be removed before it can be replaced
+            if not delete_deposition_file(ev, zenodo_id, ef, rows, sub_id, sub_title, zenodo_doi):
+                return rows
+        # Stream the file to the deposition's bucket, rather than building a multipart form
+        # https://developers.zenodo.org/#quickstart-upload
+        with ev.batch.metrics.span("upload", sub_id, event=ev.name, name=sf_name, bytes=sf_size) as span, open(sf, 'rb') as sf_file:
+            reader = UploadReader(sf_file, sf_size, f"'{sf_name}' for submission {ev.sub_label(sub_id)}", ev.batch.upload_chunk_size, ev.batch.upload_scheduler)
+            r = ev.batch.zenodo_client.put(f"{zenodo_bucket}/{quote(sf_name)}",
+                params={'access_token': ev.conf.get('ZENODO', 'api_key')},
+                headers={'Content-Type': 'application/octet-stream'},
+                data=reader)
+            span["status"] = r.status_code
+        response = r.json()
+        if r.status_code // 100 != 2:
+            rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"File upload '{sf_name}' to Zenodo returned error: {response['message']}"])
+            return rows
+        reader.report(final=True)
+        # Bucket checksums are of the form "md5:<hex>"
+        ev.state.file_uploaded(sub_id, sf_name, sf_size, response["checksum"].split(":")[-1], st.st_mtime_ns)
+    except OSError as e:
+        # Update log
+        rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Failed to open file '{sf}': {e.strerror}"])
+    except Exception as e:
+        # Update log
+        rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Uploading file '{sf_name}' to Zenodo failed: {e}"])
+    return rows
+
+def deposit_submission(ev, sub):
+    """
+    Create, upload files to and publish the Zenodo record for a single planned submission.
+    This is executed by the worker pool, so it must not prompt for input or write to the log directly.
+    Returns the list of log rows produced, in the order they occurred.
+    """
+    rows = []
+    zenodo_id = ''
+    zenodo_doi = ''
+    zenodo_bucket = ''
+    sub_id = sub["id"]
+    sub_title = sub["title"]
+    sub_metadata_hash = metadata_hash(sub["metadata"])
+    sync_action = None
+    # Resume from a previous run if this submission has already been (partially) deposited
+    state = ev.state.get(sub_id) if ev.state else None
+    if state:
+        zenodo_id, zenodo_doi, published = state
+        if published and not ev.batch.args.sync:
+            rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, "Zenodo record already published by a previous run"])
+            return rows
+        if published:
+            metadata_changed, files_changed = record_changes(ev, sub)
+            if not (metadata_changed or files_changed):
+                rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, "Zenodo record unchanged"])
+                return rows
+            # The files of a published record cannot be changed, so they require a new version, whereas metadata can be edited
+            # Either way the record is then resumed as a draft
+            sync_action = "newversion" if files_changed else "edit"
+            try:
+                # A previous run's edit/newversion may have been processed by Zenodo, but its response lost,
+                # in which case the record is already being edited, or already has a new version draft
+                with ev.batch.metrics.span("fetch_draft", sub_id, event=ev.name) as span:
+                    r = ev.batch.zenodo_client.get(ev.zenodo_api+f"api/deposit/depositions/{zenodo_id}",
+                        params={'access_token': ev.conf.get('ZENODO', 'api_key')})
+                    span["status"] = r.status_code
+                response = r.json()
+                if r.status_code // 100 != 2:
+                    rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Fetching Zenodo record returned error: {response['message']}"])
+                    return rows
+                editing = response["state"] != "done"
+                latest_draft = deposition_id(response["links"].get("latest_draft") or str(zenodo_id))
+                actions = []
+                if sync_action == "edit" and not editing:
+                    actions = ["edit"]
+                elif sync_action == "newversion" and latest_draft == zenodo_id:
+                    # A record being edited must discard the edit before it can have a new version
+                    actions = ["discard", "newversion"] if editing else ["newversion"]
+                for action in actions:
+                    with ev.batch.metrics.span(action, sub_id, event=ev.name) as span:
+                        r = ev.batch.zenodo_client.post(ev.zenodo_api+f"api/deposit/depositions/{zenodo_id}/actions/{action}",
+                            params={'access_token': ev.conf.get('ZENODO', 'api_key')})
+                        span["status"] = r.status_code
+                    response = r.json()
+                    if r.status_code // 100 != 2:
+                        rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Zenodo {action} returned error: {response['message']}"])
+                        return rows
+                    if action == "newversion":
+                        latest_draft = deposition_id(response["links"]["latest_draft"])
+                if sync_action == "newversion":
+                    # The new version's draft has its own ID, and DOI which is read when the draft is fetched below
+                    zenodo_id = latest_draft
+                    zenodo_doi = ''
+                    version = ev.state.version(sub_id)
+                    version = next_version(sub["metadata"].get("version") if version is None else version)
+                    ev.state.new_version(sub_id, zenodo_id, version or "")
+                else:
+                    ev.state.reopened(sub_id, zenodo_id, zenodo_doi)
+            except Exception as e:
+                rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Zenodo {sync_action} failed: {e}"])
+                return rows
+    # Create Zenodo draft record        
+    if sync_action:
+        print(f"Updating Zenodo record {zenodo_id} for submission {ev.sub_label(sub_id)} ({sync_action})")
+    elif state:
+        print(f"Resuming Zenodo record {zenodo_id} for submission {ev.sub_label(sub_id)}")
+    elif not ev.conf.getboolean('ZENODO', 'dry_run'):
+        try:
+            # The metadata was built whilst planning
+            data = {"metadata": sub["metadata"]}
+            with ev.batch.metrics.span("create", sub_id, event=ev.name) as span:
+                r = ev.batch.zenodo_client.post(ev.zenodo_api+"api/deposit/depositions",
+                    params={'access_token': ev.conf.get('ZENODO', 'api_key')},
+                    json=data)
+                span["status"] = r.status_code
+            # Check/Response
+            response = r.json()
+            if r.status_code // 100 != 2:
+                rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Zenodo draft creation returned error: {response['message']}"])
+                return rows
+            zenodo_id = response["id"]
+            zenodo_doi = response["metadata"]["prereserve_doi"]["doi"]
+            zenodo_bucket = response["links"]["bucket"]
+            ev.state.draft_created(sub_id, zenodo_id, zenodo_doi, sub_metadata_hash)
+        except Exception as e:
+            # Update log
+            rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Zenodo draft creation failed: {e}"])
+            return rows
+    else:
+        # Fake dry run data
+        zenodo_id = random.randint(1, 100000000)
+        zenodo_doi = random.randint(1, 100000000)
+        print(f"[DRY] Created Zenodo record for submission {ev.sub_label(sub_id)}")  
+    
+    # The files to upload were located whilst planning
+    sub_files = [f["path"] for f in sub["files"]]
+    # When resuming a draft, fetch it to find its bucket and the files Zenodo already holds, so unchanged files are not uploaded again
+    # A newly created draft has no files, so this is skipped
+    existing_files = {}
+    recorded_files = {}
+    if state:
+        try:
+            with ev.batch.metrics.span("fetch_draft", sub_id, event=ev.name) as span:
+                r = ev.batch.zenodo_client.get(ev.zenodo_api+f"api/deposit/depositions/{zenodo_id}",
+                    params={'access_token': ev.conf.get('ZENODO', 'api_key')})
+                span["status"] = r.status_code
+            response = r.json()
+            if r.status_code // 100 != 2:
+                rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Fetching Zenodo draft returned error: {response['message']}"])
+                return rows
+            # A previous run's publish may have been processed by Zenodo, but its response lost
+            if response["state"] == "done":
+                ev.state.published(sub_id)
+                rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, "Zenodo record found published whilst resuming"])
+                return rows
+            zenodo_bucket = response["links"]["bucket"]
+            for ef in response["files"]:
+                existing_files[ef["filename"]] = ef
+            if not zenodo_doi:
+                zenodo_doi = response["metadata"]["prereserve_doi"]["doi"]
+                ev.state.reopened(sub_id, zenodo_id, zenodo_doi)
+        except Exception as e:
+            rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Fetching Zenodo draft failed: {e}"])
+            return rows
+        recorded_files = ev.state.files(sub_id)
+        # Update the draft's metadata if the submission has changed since it was last sent
+        if ev.state.metadata_hash(sub_id) != sub_metadata_hash:
+            try:
+                with ev.batch.metrics.span("update", sub_id, event=ev.name) as span:
+                    r = ev.batch.zenodo_client.put(ev.zenodo_api+f"api/deposit/depositions/{zenodo_id}",
+                        params={'access_token': ev.conf.get('ZENODO', 'api_key')},
+                        json={"metadata": record_metadata(ev, sub_id, sub["metadata"])})
+                    span["status"] = r.status_code
+                response = r.json()
+                if r.status_code // 100 != 2:
+                    rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Zenodo metadata update returned error: {response['message']}"])
+                    return rows
+                ev.state.metadata_updated(sub_id, sub_metadata_hash)
+            except Exception as e:
+                rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Zenodo metadata update failed: {e}"])
+                return rows
+    # Delete files from the draft which are no longer present locally
+    sub_file_names = set(os.path.basename(sf) for sf in sub_files)
+    for ef_name in [n for n in existing_files if n not in sub_file_names]:
+        if not delete_deposition_file(ev, zenodo_id, existing_files.pop(ef_name), rows, sub_id, sub_title, zenodo_doi):
+            return rows
+    # Upload and attach files to Zenodo record, the scheduler uploads up to file_workers files at a time
+    # Uploads of a deposition's files are independent, so overlapping them hides the per-file round trips
+    uploads = []
+    for f in sub["files"]:
+        uploads.append(ev.batch.upload_scheduler.submit((ev.name, sub_id), f["size"], ev.batch.profiled, upload_file, ev, f["path"],
+            existing_files.get(f["name"]), recorded_files.get(f["name"]), sub_id, sub_title, zenodo_id, zenodo_doi, zenodo_bucket))
+    # Rows are logged in file order, regardless of the order the uploads complete
+    failed = False
+    for upload in uploads:
+        upload_rows = upload.result()
+        failed = failed or bool(upload_rows)
+        rows.extend(upload_rows)
+    # Upload rows are only produced by failures, the draft is left unpublished so that the next run completes it
+    if failed:
+        return rows
+
+    # Publish the draft record
+    if not ev.conf.getboolean('ZENODO', 'draft_only'):
+        if not ev.conf.getboolean('ZENODO', 'dry_run'):
+            try:
+                with ev.batch.metrics.span("publish", sub_id, event=ev.name) as span:
+                    r = ev.batch.zenodo_client.post(ev.zenodo_api+f"api/deposit/depositions/{zenodo_id}/actions/publish",
+                        params={'access_token': ev.conf.get('ZENODO', 'api_key')})
+                    span["status"] = r.status_code
+                response = r.json()
+                if r.status_code // 100 != 2:
+                    rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Publication of Zenodo draft returned error: {response['message']}"])
+                    return rows
+                ev.state.published(sub_id)
+            except Exception as e:
+                # Update log
+                rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, f"Publication of Zenodo draft failed: {e}"])
+                return rows
+        else:
+            print(f"[DRY] Published submission {ev.sub_label(sub_id)}")
+    # Update log
+    draft_only = ev.conf.getboolean('ZENODO', 'draft_only')
+    if sync_action == "edit":
+        status = "Zenodo record edit left as draft" if draft_only else "Zenodo record metadata edited and published"
+    elif sync_action == "newversion":
+        status = "Zenodo record new version draft created" if draft_only else "Zenodo record new version published"
+    else:
+        status = "Zenodo draft record created" if draft_only else "Zenodo record created and published"
+    rows.append([sub_id, sub_title, zenodo_id, zenodo_doi, status])
+    return rows
+
+class locked_cached_property(cached_property):
+    """cached_property whose value is only ever computed once, even if first accessed by several threads at once."""
+    lock = threading.RLock()
+
+    def __get__(self, instance, owner=None):
+        # Once computed, the value is found in the instance's __dict__ without calling this
+        with self.lock:
+            return super().__get__(instance, owner)
+
+
+class Event:
+    """
+    A conference to deposit, holding its config and the data prepared from it before any deposits are dispatched.
+    The events of a batch share the API clients, worker pool, upload folder index and metrics.
+    """
+    def __init__(self, batch, name, conf):
+        self.batch = batch
+        self.name = name
+        self.conf = conf
+        self.event_id = conf.get('OXFORD_ABSTRACTS', 'event_id')
+        # https://app.oxfordabstracts.com/new-graphql-api-key
+        # api_url can be overridden, e.g. to use mock_server.py
+        self.oa_api = conf.get('OXFORD_ABSTRACTS', 'api_url', fallback="https://app.oxfordabstracts.com/v1/graphql")
+        # Oxford Abstracts responses are cached, as fetching them is the slowest part of startup
+        self.oa_cache_dir = conf.get('OXFORD_ABSTRACTS', 'cache_dir', fallback='oa2zenodo_cache')
+        # Maximum age (seconds) of cached responses to use, 0 always fetches (but still caches for --offline)
+        self.oa_cache_ttl = conf.getint('OXFORD_ABSTRACTS', 'cache_ttl', fallback=0)
+        # Number of submissions to fetch per request, smaller pages begin processing sooner
+        self.oa_page_size = conf.getint('OXFORD_ABSTRACTS', 'page_size', fallback=50)
+
+        # Offline runs cannot make any Zenodo API calls
+        if batch.args.offline and not conf.getboolean('ZENODO', 'dry_run'):
+            print(f"Offline mode, forcing dry_run=TRUE for event '{name}'.")
+            conf['ZENODO']['dry_run'] = 'TRUE'
+        if conf.getboolean('ZENODO', 'fake_upload') and not conf.getboolean('ZENODO', 'use_sandbox'):
+            raise ConfigError(f"fake_upload=TRUE is not compatible with use_sandbox=FALSE (event '{name}').")
+
+        self.zenodo_api = "https://sandbox.zenodo.org/" if conf.getboolean('ZENODO', 'use_sandbox') else "https://zenodo.org/"
+        # api_url can be overridden, e.g. to use mock_server.py
+        if 'api_url' in conf['ZENODO']:
+            self.zenodo_api = conf.get('ZENODO', 'api_url').rstrip("/") + "/"
+        # Setup the target Zenodo communities in the correct format
+        self.communities = [{"identifier":comm} for comm in conf.get('ZENODO', 'community_identifiers').split()]
+        self.keywords = conf.get('ZENODO', 'keywords').split()
+        # Process skipped submissions into a set of integers
+        self.skipped_submissions = set()
+        if 'skipped_submissions' in conf['ZENODO']:
+            self.skipped_submissions = set([int(i) for i in conf['ZENODO']['skipped_submissions'].split()])
+        # Files matching the blacklist are never uploaded
+        self.file_blacklist = NameMatcher(conf_patterns(conf, 'file_blacklist'))
+        # If provided, only files matching the allowlist are uploaded
+        self.file_allowlist = NameMatcher(conf_patterns(conf, 'file_allowlist'))
+        # Directories matching this are not searched for files to upload
+        self.dir_blacklist = NameMatcher(conf_patterns(conf, 'dir_blacklist'))
+        self.log_path = batch.batch_path('oa2zenodo_log.csv', name)
+
+        # Futures of the Oxford Abstracts queries, started by prefetch()
+        self.programme = None
+        self.first_page = None
+        # Populated by prepare()
+        self.fake_file_path = ""
+        self.programme_submissions = defaultdict(list)
+        self.programme_session_names = defaultdict(dict) # Unique session names of each submission, dict as an insertion ordered set
+        self.programme_submission_info = {} # Submission detail from the programme, used to select sessions before submissions are fetched
+        self.programme_plenary = [] # Not strictly plenary, sessions without a submission or column
+        self.upload_dirs = {} # submission id: upload folder path
+        self.youtube_urls = {} # submission id: youtube url
+        self.skipped_sessions = set()
+        self.session_selections = {} # submission global id: (session name, skip reason)
+
+    @locked_cached_property
+    def state(self):
+        """The event's StateStore, opened on first use. Progress is not recorded for dry runs, as they use fake Zenodo IDs."""
+        if self.conf.getboolean('ZENODO', 'dry_run'):
+            return None
+        return StateStore(self.conf.get('ZENODO', 'state_db', fallback='oa2zenodo_state.db'), self.zenodo_api, self.event_id)
+
+    def sub_label(self, sub_id):
+        """A submission's name in progress messages, prefixed with the event in batches (as in Metrics.summary)."""
+        return f"{self.name} #{sub_id}" if len(self.batch.events) > 1 else f"#{sub_id}"
+
+    def prefetch(self):
+        """Start fetching the programme and the first page of submissions concurrently, before they are required."""
+        query = dict(FETCH_PROGRAMME_QUERY, variables={"event_id": self.event_id})
+        self.programme = self.batch.oa_executor.submit(fetch_oa, self, query, "programme")
+        self.first_page = self.batch.oa_executor.submit(fetch_oa_page, self, 0)
+
+    def prepare(self):
+        """Load everything required to plan the event's submissions, this may prompt the user. Not required to execute a --plan."""
+        self.load_programme()
+        # Locate fake file if requested
+        if self.conf.getboolean('ZENODO', 'fake_upload'):
+            fake_file = None
+            while not fake_file:
+                self.fake_file_path = input("Specify location of fake file to use for Sandbox uploads: ")
+                fake_file = open(self.fake_file_path, 'rb')
+            fake_file.close()
+        # Index the upload folders, this isn't required if every record receives the fake file
+        else:
+            self.index_uploads()
+        self.load_youtube_urls()
+        self.select_sessions()
+
+    def index_uploads(self):
+        """Locate the upload folder of each submission, using the batch's shared index of the upload folders."""
+        with self.batch.metrics.span("index", event=self.name):
+            self.upload_dirs = self.batch.upload_index.find_upload_dirs(self.conf['ZENODO']['file_search_root'])
+
+    def load_programme(self):
+        # Process raw graphql response into a cleaner format
+        if not self.programme:
+            self.prefetch()
+        for programme_date in self.programme.result()["events_by_pk"]["program_dates"]:
+            date = programme_date["program_date"]
+            for programme_session in programme_date["program_sessions"]:
+                # If there is no column it's a plenary session
+                if len(programme_session["program_sessions_program_columns"]) + len(programme_session["program_sessions_submissions"]) == 0:
+                    self.programme_plenary.append(ProgrammeItem(
+                        date,
+                        programme_session["start_time"],
+                        programme_session["end_time"],
+                        programme_session["name"],
+                        "Plenary"))
+                else:
+                    for programme_submission in programme_session["program_sessions_submissions"]:
+                        self.programme_submission_info[programme_submission["submission_id"]] = programme_submission["submission"]
+                        t = programme_session["program_sessions_program_columns"]
+                        track = t[0]["program_column"]["name"] if len(t) else "Plenary"
+                        self.programme_submissions[programme_submission["submission_id"]].append(ProgrammeItem(
+                            date,
+                            programme_session["start_time"],
+                            programme_session["end_time"],
+                            programme_session["name"],
+                            track))
+                        self.programme_session_names[programme_submission["submission_id"]][programme_session["name"]] = None
+
+        #print("-----Programme Plenary Info-----")
+        #for a in self.programme_plenary:
+        #  print(a)
+
+        #print("-----Programme Submission Info-----")
+        #for a,b in self.programme_submissions.items():
+        #  for t in b:
+        #    print("%s: %s"%(a, t))
+
+    def load_youtube_urls(self):
+        # Build a map of id:youtube-url
+        if "youtube_csv" not in self.conf['ZENODO']:
+            return
+        if not ("youtube_csv_id" in self.conf['ZENODO'] and "youtube_csv_url" in  self.conf['ZENODO']):
+            raise Exception("Input contains 'youtube_csv', but not both 'youtube_csv_id' and 'youtube_csv_url' which denote column headings")
+        with open(self.conf['ZENODO']['youtube_csv'], mode='r', newline='', encoding='utf-8') as csvfile:
+            reader = csv.DictReader(csvfile)
+            key = self.conf['ZENODO']['youtube_csv_id']
+            val = self.conf['ZENODO']['youtube_csv_url']
+            for row in reader:
+                # Only use rows that have data
+                if len(row[key]) and len(row[val]):
+                    try:
+                        # Regular 1:1 matches
+                        self.youtube_urls[int(row[key])] = row[val]
+                    except ValueError:
+                        i = row[key].split(",")
+                        for j in i:
+                            # N:1 matches (Poster lighting talks)
+                            self.youtube_urls[int(j)] = row[val]
+
+    def select_sessions(self):
+        # Select the session of each submission in the programme before any deposits are dispatched, as this may prompt the user
+        # Submissions are processed in ascending ID order, so selections (and skipped_sessions) are made in that same order
+        for sub_global_id in sorted(self.programme_submissions):
+            info = self.programme_submission_info[sub_global_id]
+            # Only accepted submissions are processed
+            if (info is None or info["archived"] or not info["decision"] or info["decision"]["value"] != "Accepted"
+            or info["serial_number"] in self.skipped_submissions):
+                continue
+            sub_title = info["title"][0]["without_html"] if isinstance(info["title"], list) else info["title"]["without_html"]
+            # Filter out previously skipped session names (duplicates were removed when the programme was processed)
+            matching_sessions = [n for n in self.programme_session_names[sub_global_id] if n not in self.skipped_sessions]
             # Perform selection
             if len(matching_sessions)==0:
-                log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, f"Found only in previously skipped sessions, so ignored."])
-                continue
+                self.session_selections[sub_global_id] = (None, "Found only in previously skipped sessions, so ignored.")
             elif len(matching_sessions)==1:
-                sub_conference_session = matching_sessions[0]
+                self.session_selections[sub_global_id] = (matching_sessions[0], None)
             else:
                 # Submission is attached to multiple sessions, use input to offer user to select which is preferred
                 # @todo, allow selection of multiple/all?
@@ -303,171 +1496,440 @@ with open('oa2zenodo_log.csv', 'w', newline='') as logfile:
                     menu_txt += f"{i+1}: '{matching_sessions[i]}'\n"
                 menu_txt += f"{0}: Skip this submission\n"
                 response = None
-                while not response:
+                while response is None:
                   try:
                       response = int(input(menu_txt))
+                      if not 0 <= response <= len(matching_sessions):
+                          raise ValueError()
                   except ValueError:
+                      response = None
                       print(f"An response in the inclusive range [0-{len(matching_sessions)}] required.")
                 if response == 0:
-                    log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, f"Found in multiple sessions and skipped by user."])
+                    self.session_selections[sub_global_id] = (None, "Found in multiple sessions and skipped by user.")
                     continue
-                sub_conference_session = matching_sessions[response-1]
+                self.session_selections[sub_global_id] = (matching_sessions[response-1], None)
                 for i in range(len(matching_sessions)):
                     if i != response-1:
-                        skipped_sessions.add(matching_sessions[i])
-                 
-            
-        # Locate responses (abstract, upload_approval)
-        for response in submission["responses"]:
-            # abstract
-            if response["question"]["question_name"] == "Abstract":
-                sub_abstract = response["value"]
-            # permission to publish
-            elif response["question"]["question_name"] == "Permission to Publish":
-                if response["value"] == "yes":
-                    sub_has_permission = True
-        if not sub_has_permission:
-            log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, f"Permission to publish denied."])
-            continue
-
-        # Append YouTube URL if available
-        if sub_id in YOUTUBE_URLS:
-            sub_abstract += f"\nA recording of this session is available on YouTube: <a href=\"{YOUTUBE_URLS[sub_id]}\">{YOUTUBE_URLS[sub_id]}</a>"
-
-        # Extract author detail
-        for author in submission["authors"]:
-            a = dict()
-            a["type"] = "ProjectMember" # Required field with controlled vocab, which we aren't collecting
-            a["name"] = f"{author['last_name']}, {author['first_name']}"
-            affiliations = ""
-            for i in range(len(author["affiliations"])):
-                if i != 0:
-                    affiliations += ", "
-                affiliations += author["affiliations"][i]["institution"]
-            if affiliations:
-                a["affiliation"] = author["orcid_id"]
-            if author["orcid_id"]:
-                a["orcid"] = author["orcid_id"]
-            sub_authors.append(a)
-        # Create Zenodo draft record        
-        if not conf.getboolean('ZENODO', 'dry_run'):
-            try:
-                # https://developers.zenodo.org/#representation
-                data = {  
-                  "metadata":{
-                    "upload_type": sub_type,
-                    "title": sub_title,
-                    "creators": sub_authors,
-                    "description": sub_abstract,
-                    "access_right": "open",
-                    "license": "cc-by",
-                    "keywords": ZENODO_KEYWORDS,
-                    "communities": ZENODO_COMMUNITIES,
-                    "conference_title": conf.get('ZENODO', 'conference_title'),
-                    "conference_acronym": conf.get('ZENODO', 'conference_acronym'),
-                    "conference_dates": conf.get('ZENODO', 'conference_dates'),
-                    "conference_place": conf.get('ZENODO', 'conference_place'),
-                    "conference_url": conf.get('ZENODO', 'conference_url'),
-                    "conference_session": sub_conference_session,
-                    #"conference_session_part": "", # @todo In future, 2024 no (standard) session has multiple parts
-                    #"grants": [{"id":"10.13039/501100000780::283595"}],# I don't think we are currently collecting this info
-                    "version": "1.0.0",
-                    "language": "eng",
-                    #"notes": ""# In future can add youtube link to notes
-                  }
-                }
-                r = requests.post(ZENODO_API+"api/deposit/depositions",
-                    params={'access_token': conf.get('ZENODO', 'api_key')},
-                    json=data)
-                # Check/Response
-                response = r.json()
-                if r.status_code // 100 != 2:
-                    log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, f"Zenodo draft creation returned error: {response['message']}"])
-                    continue
-                zenodo_id = response["id"]
-                zenodo_doi = response["metadata"]["prereserve_doi"]["doi"]
-            except Exception as e:
-                # Update log
-                log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, f"Zenodo draft creation failed: {e.message()}"])
-                continue
-        else:
-            # Fake dry run data
-            zenodo_id = random.randint(1, 100000000)
-            zenodo_doi = random.randint(1, 100000000)
-            print(f"[DRY] Created Zenodo record for submission #{sub_id}")  
-        
-        # Create a list for this submissions files
-        sub_files = []
-        if conf.getboolean('ZENODO', 'fake_upload'):
-            sub_files.append(fake_file_path)
-        else:
-          # @todo User input to confirm files
-          # Locate the folder corresponding to the file's ID
-          if not sub_id in UPLOAD_DIRS:
-              # The cloudkubed sponsor workshop (#174) doesn't have a google drive directory
-                log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, f"Google drive directory missing"])
-                continue
-          sub_folder = UPLOAD_DIRS[sub_id]
-          # Check whether there is a "zenodo" directory (case-insensitive)
-          for f in os.listdir(sub_folder):
-              t_sub_folder = os.path.join(sub_folder, f)
-              if os.path.isdir(t_sub_folder) and f.lower() == "zenodo":
-                  sub_folder = t_sub_folder
-                  break
-          # Locate all files to be uploaded
-          sub_files = []
-          for root, _, files in os.walk(sub_folder):
+                        self.skipped_sessions.add(matching_sessions[i])
+
+def plan_submission(ev, submission):
+    """
+    Plan the deposit of an event's submission fetched from Oxford Abstracts, without any network writes.
+    Returns a JSON serialisable dict, holding either the skip_reason or the Zenodo metadata and files to upload.
+    """
+    sub_global_id = submission["id"] # This is a globally unique ID
+    sub_id = submission["serial_number"] # This is ID from within OA website
+    sub_title = submission["title"][0]["without_html"]
+    sub_approve_upload = False
+    sub_type = accepted_for_to_upload_type(submission["accepted_for"]["value"])
+    sub_conference_session = None
+    plan = {"id": sub_id, "title": sub_title, "skip_reason": None, "metadata": None, "files": []}
+    if sub_id in ev.skipped_submissions:
+        return dict(plan, skip_reason="Skipped as requested by config")
+    # Locate session info
+    if sub_global_id in ev.session_selections:
+        sub_conference_session, skip_reason = ev.session_selections[sub_global_id]
+        if skip_reason:
+            return dict(plan, skip_reason=skip_reason)
+
+    # Locate responses (abstract, upload_approval) via a map of question name:response value
+    responses = {r["question"]["question_name"]: r["value"] for r in submission["responses"]}
+    sub_abstract = responses.get("Abstract", "")
+    sub_has_permission = responses.get("Permission to Publish") == "yes"
+    if not sub_has_permission:
+        return dict(plan, skip_reason="Permission to publish denied.")
+
+    # Append YouTube URL if available
+    if sub_id in ev.youtube_urls:
+        sub_abstract += f"\nA recording of this session is available on YouTube: <a href=\"{ev.youtube_urls[sub_id]}\">{ev.youtube_urls[sub_id]}</a>"
+
+    # Extract author detail
+    sub_authors = [Author(author).to_creator() for author in submission["authors"]]
+
+    # Locate files to upload
+    sub_files = []
+    fake_upload = ev.conf.getboolean('ZENODO', 'fake_upload')
+    if fake_upload:
+        sub_files.append(ev.fake_file_path)
+    else:
+      # @todo User input to confirm files
+      # Locate the folder corresponding to the file's ID
+      if not sub_id in ev.upload_dirs:
+          # The cloudkubed sponsor workshop (#174) doesn't have a google drive directory
+            return dict(plan, skip_reason="Google drive directory missing")
+      sub_folder = ev.upload_dirs[sub_id]
+      # Check whether there is a "zenodo" directory (case-insensitive)
+      for f in ev.batch.upload_index.listing(sub_folder)["dirs"]:
+          if f.lower() == "zenodo":
+              sub_folder = os.path.join(sub_folder, f)
+              break
+      # Locate all files to be uploaded
+      with ev.batch.metrics.span("files", sub_id, event=ev.name):
+          for root, _, files in ev.batch.upload_index.walk(sub_folder, prune=ev.dir_blacklist.match):
               for file in files:
-                  skip = False
-                  for test_filename in FILE_BLACKLIST:
-                      if fnmatch(file.lower(), test_filename.lower()):
-                          skip = True
-                          break
-                  if not skip:
+                  if ev.file_blacklist.match(file):
+                      continue
+                  if ev.file_allowlist.empty or ev.file_allowlist.match(file):
                     sub_files.append(os.path.join(root, file))
-        # Upload and attach files to Zenodo record
-        for sf in sub_files:
-            # @todo Filter out certain files (e.g. transcripts, google slides, desktop.ini)                
-            if not conf.getboolean('ZENODO', 'dry_run'):
-                try:
-                    sf_name = os.path.basename(sf)
-                    sf_file = open(sf, 'rb')
-                    r = requests.post(ZENODO_API+f"api/deposit/depositions/{zenodo_id}/files",
-                        params={'access_token': conf.get('ZENODO', 'api_key')},
-                        data={"name": sf_name},
-                        files={'file': sf_file})
-                    response = r.json()
-                    if r.status_code // 100 != 2:
-                        log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, f"File upload '{sf_name}' to Zenodo returned error: {response['message']}"])
-                        continue
-                except OSError as e:
-                    # Update log
-                    log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, f"Failed to open file '{sf}': {e.strerror}"])
-                except Exception as e:
-                    # Update log
-                    log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, f"Uploading file '{sf_name}' to Zenodo failed: {e.message()}"])
-                    continue
+    # Sizes are taken from the index where available, to avoid further stat calls
+    for sf in sub_files:
+        listing = None if fake_upload else ev.batch.upload_index.dirs.get(os.path.dirname(sf))
+        size = listing["files"][os.path.basename(sf)][0] if listing else os.path.getsize(sf)
+        plan["files"].append({"path": sf, "name": os.path.basename(sf), "size": size})
+
+    # https://developers.zenodo.org/#representation
+    plan["metadata"] = {
+        "upload_type": sub_type,
+        "title": sub_title,
+        "creators": sub_authors,
+        "description": sub_abstract,
+        "access_right": "open",
+        "license": "cc-by",
+        "keywords": ev.keywords,
+        "communities": ev.communities,
+        "conference_title": ev.conf.get('ZENODO', 'conference_title'),
+        "conference_acronym": ev.conf.get('ZENODO', 'conference_acronym'),
+        "conference_dates": ev.conf.get('ZENODO', 'conference_dates'),
+        "conference_place": ev.conf.get('ZENODO', 'conference_place'),
+        "conference_url": ev.conf.get('ZENODO', 'conference_url'),
+        "conference_session": sub_conference_session,
+        #"conference_session_part": "", # @todo In future, 2024 no (standard) session has multiple parts
+        #"grants": [{"id":"10.13039/501100000780::283595"}],# I don't think we are currently collecting this info
+        "version": "1.0.0",
+        "language": "eng",
+        #"notes": ""# In future can add youtube link to notes
+    }
+    return plan
+
+def generate_plan(ev):
+    """Yield the plan of each of an event's submissions, fetching them from Oxford Abstracts or loading them from --plan."""
+    if ev.batch.planning:
+        for submission in fetch_oa_submissions(ev):
+            with ev.batch.metrics.span("metadata", submission["serial_number"], event=ev.name):
+                plan = plan_submission(ev, submission)
+            yield plan
+    else:
+        plan_path = ev.batch.batch_path(ev.batch.args.plan, ev.name)
+        with open(plan_path, "r", encoding="utf-8") as plan_file:
+            plan = json.load(plan_file)
+        if plan["event_id"] != ev.event_id or plan["zenodo_api"] != ev.zenodo_api:
+            raise ConfigError(f"The plan '{plan_path}' was created for event {plan['event_id']} on {plan['zenodo_api']}, which does not match the config.")
+        yield from plan["submissions"]
+
+def interleave_plans(events):
+    """
+    Yield (event, plan) for every submission of the events, moving to the next event after each deposit,
+    so that a batch's deposits share the worker pool fairly rather than being processed an event at a time.
+    """
+    plans = [(ev, generate_plan(ev)) for ev in events]
+    while plans:
+        for ev, ev_plans in list(plans):
+            # Skipped submissions don't occupy a worker, so they don't end the event's turn
+            for p in ev_plans:
+                yield ev, p
+                if not p["skip_reason"]:
+                    break
             else:
-                print(f"[DRY] Uploaded '{sf}' for submission #{sub_id}")
-            
-        # Publish the draft record
-        if not conf.getboolean('ZENODO', 'draft_only'):
-            if not conf.getboolean('ZENODO', 'dry_run'):
+                plans.remove((ev, ev_plans))
+
+def summarise_plan(batch, entries):
+    """Print the number of records and bytes to upload, with an estimate of the run time from the previous run's metrics."""
+    deposits = [e for e in entries if not e["skip_reason"]]
+    total_files = sum(len(e["files"]) for e in deposits)
+    total_bytes = sum(f["size"] for e in deposits for f in e["files"])
+    print(f"Plan: {len(deposits)} records to deposit, {len(entries) - len(deposits)} skipped, "
+        f"{total_files} files totalling {total_bytes/(1024*1024):.1f} MB")
+    if batch.metrics.previous:
+        record_seconds, bytes_per_second = batch.metrics.previous
+        estimate = (len(deposits) * record_seconds + total_bytes / bytes_per_second) / batch.workers
+        # Uploads cannot complete faster than the bandwidth budget permits
+        if batch.upload_bytes_per_second:
+            estimate = max(estimate, total_bytes / batch.upload_bytes_per_second)
+        print(f"Estimated run time {estimate/60:.1f} minutes with {batch.workers} workers, "
+            f"based on the previous run ({record_seconds:.1f}s per record, {bytes_per_second/(1024*1024):.2f} MB/s per upload)")
+
+def chain_future(source, target):
+    """Complete the target future with the outcome of the source future, once it is done."""
+    def copy(_):
+        if source.exception():
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+    source.add_done_callback(copy)
+
+def write_ready(log, logfile, results, wait=False):
+    """
+    Write the log rows of leading results which have completed, removing them from results.
+    Rows are always written in submission order. If wait, block until all results are written.
+    """
+    while results and (wait or not isinstance(results[0], Future) or results[0].done()):
+        result = results.pop(0)
+        rows = result.result() if isinstance(result, Future) else result
+        for row in rows:
+            log.writerow(row)
+        logfile.flush()
+
+
+class Batch:
+    """
+    The events of a run, and the resources they share. Settings shared by every event (workers, connection pools,
+    rate limits, upload folder index, metrics) are taken from the first event's config.
+    Shared resources are created on first use, so each command only initialises what it requires.
+    """
+    def __init__(self, args):
+        self.args = args
+        # Executing a saved plan requires no Oxford Abstracts data, upload folder index or prompts
+        self.planning = not args.plan
+        self.event_confs = load_event_confs(args.conf_paths)
+        self.conf = self.event_confs[0][1]
+        # Number of submissions to deposit concurrently, each worker handles a whole submission
+        # A batch's events share the workers
+        self.workers = self.conf.getint('ZENODO', 'workers', fallback=1)
+        if self.workers < 1:
+            raise ConfigError("Config 'ZENODO' key 'workers' must be at least 1.")
+        # Number of each submission's files to upload concurrently
+        self.file_workers = self.conf.getint('ZENODO', 'file_workers', fallback=1)
+        if self.file_workers < 1:
+            raise ConfigError("Config 'ZENODO' key 'file_workers' must be at least 1.")
+        # Size of each read when streaming a file to Zenodo, this bounds the memory used per upload
+        self.upload_chunk_size = self.conf.getint('ZENODO', 'upload_chunk_size', fallback=1024*1024)
+        # Order of deposits and their file uploads, by size
+        self.upload_order = self.conf.get('ZENODO', 'upload_order', fallback='plan')
+        if self.upload_order not in UPLOAD_ORDERS:
+            raise ConfigError(f"Config 'ZENODO' key 'upload_order' must be one of: {', '.join(UPLOAD_ORDERS)}.")
+        # Total upload bandwidth of every worker, 0 is unlimited
+        self.upload_bytes_per_second = self.conf.getint('ZENODO', 'upload_bytes_per_second', fallback=0)
+        self.max_retries = self.conf.getint('ZENODO', 'max_retries', fallback=5)
+        # https://developers.zenodo.org/#rate-limiting
+        self.requests_per_minute = self.conf.getint('ZENODO', 'requests_per_minute', fallback=100)
+        # Before Python 3.12 workers are profiled separately (cProfile only profiles the thread that enables it),
+        # and merged at the end of the run
+        self.profiles = []
+        self.events = [Event(self, name, event_conf) for name, event_conf in self.event_confs]
+
+    @locked_cached_property
+    def metrics(self):
+        # Only runs which deposit to Zenodo write metrics, so that the previous run's are retained for estimates
+        # Dry runs (including --offline) make no Zenodo requests, so they would leave nothing to estimate from
+        write = (self.args.command in ("run", "upload") and not self.args.plan_out
+            and not all(ev.conf.getboolean('ZENODO', 'dry_run') for ev in self.events))
+        return Metrics(self.conf.get('ZENODO', 'metrics_file', fallback='oa2zenodo_metrics.jsonl'), write)
+
+    @locked_cached_property
+    def oa_client(self):
+        return ApiClient(pool_size=2, max_retries=self.max_retries)
+
+    @locked_cached_property
+    def oa_executor(self):
+        # Oxford Abstracts queries are made by a pool of 2, so the programme and the first page of submissions
+        # (or the next page of submissions, whilst the current page is planned) are fetched concurrently
+        return ThreadPoolExecutor(max_workers=2)
+
+    @locked_cached_property
+    def zenodo_client(self):
+        # Shared by all workers (and events), so that connections and rate limits are pooled
+        return ApiClient(pool_size=self.workers * self.file_workers, max_retries=self.max_retries,
+            requests_per_minute=self.requests_per_minute)
+
+    @locked_cached_property
+    def upload_scheduler(self):
+        # File uploads are performed by a separate pool, large enough that every worker can upload file_workers files at once
+        return UploadScheduler(self.workers * self.file_workers, self.file_workers, self.upload_order, self.upload_bytes_per_second)
+
+    @locked_cached_property
+    def upload_index(self):
+        # A single index of the upload folders is shared by every event, this isn't required if every record receives the fake file
+        return FileIndex(self.conf.get('ZENODO', 'file_index', fallback='oa2zenodo_index.json'))
+
+    def batch_path(self, path, event_name):
+        """Path of an event's copy of a per-event file, paths are only suffixed with the event name when processing a batch."""
+        if len(self.event_confs) == 1:
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}_{event_name}{ext}"
+
+    def profiled(self, fn, *fn_args):
+        """Call fn, profiling it if --profile was passed"""
+        # From Python 3.12 cProfile uses sys.monitoring, so main()'s profiler already covers every thread,
+        # and only one profiler may be active at a time
+        if not self.args.profile or sys.version_info >= (3, 12):
+            return fn(*fn_args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fn, *fn_args)
+        finally:
+            self.profiles.append(profile)
+
+    def validate(self):
+        """Check the paths referenced by each event's config exist, beyond the checks made whilst loading it."""
+        valid = True
+        for ev in self.events:
+            zenodo = ev.conf['ZENODO']
+            if not zenodo.getboolean('fake_upload') and not os.path.isdir(zenodo.get('file_search_root', '')):
+                print(f"Event '{ev.name}' config 'ZENODO' key 'file_search_root' is not a directory.")
+                valid = False
+            if "youtube_csv" in zenodo:
+                if not ("youtube_csv_id" in zenodo and "youtube_csv_url" in zenodo):
+                    print(f"Event '{ev.name}' config contains 'youtube_csv', but not both 'youtube_csv_id' and 'youtube_csv_url'.")
+                    valid = False
+                if not os.path.isfile(zenodo['youtube_csv']):
+                    print(f"Event '{ev.name}' config 'ZENODO' key 'youtube_csv' file was not found.")
+                    valid = False
+        if not valid:
+            raise ConfigError("Config invalid.")
+        print(f"Config valid: {len(self.events)} event(s) {', '.join(ev.name for ev in self.events)}")
+
+    def fetch(self):
+        """Fetch every event's programme and submissions from Oxford Abstracts, populating the cache."""
+        for ev in self.events:
+            ev.prefetch()
+        for ev in self.events:
+            ev.programme.result()
+            count = sum(1 for _ in fetch_oa_submissions(ev))
+            print(f"Fetched {count} submissions for event '{ev.name}'")
+
+    def index(self):
+        """Index the upload folders of every event, retaining the listings for the next run."""
+        for ev in self.events:
+            if ev.conf.getboolean('ZENODO', 'fake_upload'):
+                continue
+            ev.index_uploads()
+            print(f"Found {len(ev.upload_dirs)} upload folders for event '{ev.name}'")
+
+    def prepare(self):
+        """Prepare every event before any deposits are dispatched, so that all prompts are asked up front."""
+        for ev in self.events:
+            ev.prefetch()
+        for ev in self.events:
+            if len(self.events) > 1:
+                print(f"-----Preparing event '{ev.name}'-----")
+            ev.prepare()
+
+    def write_plans(self):
+        """Write the complete plan of each event, without any Zenodo writes."""
+        for ev in self.events:
+            entries = list(generate_plan(ev))
+            plan_path = self.batch_path(self.args.plan_out, ev.name)
+            with open(plan_path, "w", encoding="utf-8") as plan_file:
+                json.dump({"event_id": ev.event_id, "zenodo_api": ev.zenodo_api,
+                    "created": time.time(), "submissions": entries}, plan_file, indent=2)
+            print(f"Plan written to '{plan_path}'")
+            summarise_plan(self, entries)
+
+    def dispatch(self, executor, ev, p):
+        """Submit a planned deposit to the worker pool, returning the future of its log rows."""
+        deposition = (ev.name, p["id"])
+        self.upload_scheduler.expect(deposition, sum(f["size"] for f in p["files"]))
+        deposit = executor.submit(self.profiled, deposit_submission, ev, p)
+        deposit.add_done_callback(lambda _: self.upload_scheduler.finished(deposition))
+        return deposit
+
+    def deposit(self):
+        """Deposit every event's submissions, logging the outcome of each to the event's log."""
+        # Create an output file per event to log progress of records
+        with ExitStack() as stack:
+            logs = {} # event name: (csv writer, log file, results)
+            for ev in self.events:
+                logfile = stack.enter_context(open(ev.log_path, 'w', newline=''))
+                log = csv.writer(logfile, dialect='excel')
+                # Write header
+                log.writerow(['submission_id', 'submission_title', 'zenodo_id', 'doi', 'status'])
+                logs[ev.name] = (log, logfile, [])
+            # Dispatch each submission to the worker pool as soon as it has been planned
+            # Each result is either a list of log rows (submission was skipped) or the future of a deposit
+            # Ordering deposits by size requires every plan, so they are dispatched once all are planned,
+            # to futures which retain their place in the log
+            ordered = [] # (size, event, plan, future of log rows)
+            error = None
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
                 try:
-                    r = requests.post(ZENODO_API+f"api/deposit/depositions/{zenodo_id}/actions/publish",
-                        params={'access_token': conf.get('ZENODO', 'api_key')})
-                    response = r.json()
-                    if r.status_code // 100 != 2:
-                        log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, f"Publication of Zenodo draft returned error: {response['message']}"])
-                        continue
-                except Exception as e:
-                    # Update log
-                    log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, f"Publication of Zenodo draft failed: {e.message()}"])
-                    continue
-            else:
-                print(f"[DRY] Published submission #{sub_id}")
-        # Update log
-        if conf.getboolean('ZENODO', 'draft_only'):
-            log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, "Zenodo draft record created"])
+                    for ev, p in interleave_plans(self.events):
+                        log, logfile, results = logs[ev.name]
+                        if p["skip_reason"]:
+                            results.append([[p["id"], p["title"], '', '', p["skip_reason"]]])
+                        elif self.upload_order == "plan":
+                            results.append(self.dispatch(executor, ev, p))
+                        else:
+                            results.append(Future())
+                            ordered.append((sum(f["size"] for f in p["files"]), ev, p, results[-1]))
+                        # Only the main thread writes to the logs
+                        write_ready(log, logfile, results)
+                except Oa2ZenodoError as e:
+                    # Stop dispatching (e.g. a page of submissions could not be fetched),
+                    # but finish and log the deposits already dispatched
+                    error = e
+                    for _, ev, p, rows in ordered:
+                        rows.set_result([[p["id"], p["title"], '', '', "Not deposited, as the run was stopped by an error"]])
+                    ordered = []
+                # Sorting is stable, so deposits of equal size retain their order
+                priority = UPLOAD_ORDERS[self.upload_order]
+                for _, ev, p, rows in sorted(ordered, key=lambda o: priority(o[0])):
+                    chain_future(self.dispatch(executor, ev, p), rows)
+                for log, logfile, results in logs.values():
+                    write_ready(log, logfile, results, wait=True)
+            if error:
+                raise error
+
+    def finish(self):
+        """Release the resources which were used, and summarise the run's metrics."""
+        for executor in ("oa_executor", "upload_scheduler"):
+            if executor in self.__dict__:
+                self.__dict__[executor].shutdown()
+        # Retain the listings of upload folders for the next run
+        if "upload_index" in self.__dict__:
+            self.upload_index.save()
+        if "metrics" in self.__dict__:
+            self.metrics.summary()
+
+def main(argv=None):
+    """
+    Command line entry point, argv defaults to sys.argv[1:].
+    Exits with status 1 if the run is stopped by an Oa2ZenodoError (or invalid config value), or 2 for invalid arguments.
+    """
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.tracemalloc:
+        tracemalloc.start()
+    if args.profile:
+        main_profile = cProfile.Profile()
+        main_profile.enable()
+    try:
+        batch = Batch(args)
+        if args.validate_config:
+            batch.validate()
+            return
+    except ValueError as e:
+        print(f"Invalid config value: {e}")
+        sys.exit(1)
+    except Oa2ZenodoError as e:
+        print(e)
+        sys.exit(1)
+    try:
+        if args.command == "fetch":
+            batch.fetch()
+        elif args.command == "index":
+            batch.index()
         else:
-            log.writerow([sub_id, sub_title, zenodo_id, zenodo_doi, "Zenodo record created and published"])
+            if batch.planning:
+                batch.prepare()
+            if args.plan_out:
+                batch.write_plans()
+            else:
+                batch.deposit()
+    except Oa2ZenodoError as e:
+        batch.finish()
+        print(e)
+        sys.exit(1)
+    batch.finish()
+    if args.profile:
+        main_profile.disable()
+        stats = pstats.Stats(main_profile, *batch.profiles)
+        stats.dump_stats("oa2zenodo.prof")
+        stats.sort_stats("cumulative").print_stats(20)
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"-----Memory: {current/(1024*1024):.1f} MB current, {peak/(1024*1024):.1f} MB peak-----")
+        for stat in tracemalloc.take_snapshot().statistics("lineno")[:10]:
+            print(stat)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""
+End-to-end tests of resuming and syncing deposits, running oa2zenodo.py against mock_server.py,
+and tests of the retry policy, Oxford Abstracts cache and paging.
+
+python3 -m pytest test_oa2zenodo.py
+"""
+import csv, re, subprocess, sys, threading, time
+import pytest, requests
+import oa2zenodo
+from benchmark import CONFIG_TEMPLATE, OA2ZENODO
+from mock_server import MockServer, generate_event, generate_files
+from oa2zenodo import ApiClient, ConfigError, UploadScheduler, load_event_confs, main
+
+SUBMISSIONS = 12
+
+@pytest.fixture
+def server():
+    """A mock server of a synthetic event."""
+    submissions, program_dates = generate_event(SUBMISSIONS, seed=1)
+    server = MockServer(submissions, program_dates, seed=1).start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def event(tmp_path, server):
+    """
+    Returns (mock server, upload root, run) for a synthetic event, where run(*args, **config) runs oa2zenodo.py.
+    run asserts the exit status is returncode (default 0), and returns the statuses logged (None if nothing was deposited).
+    """
+    upload_root = tmp_path / "uploads"
+    generate_files(upload_root, [s["serial_number"] for s in server.submissions], files_per_submission=3, median_size=16*1024, seed=1)
+    run_dir = tmp_path / "run"
+    run_dir.mkdir()
+
+    def run(*args, draft_only=False, dry_run=False, page_size=5, cache_ttl=0, extra_conf="", returncode=0):
+        conf = CONFIG_TEMPLATE.format(url=server.url, workers=2, file_workers=2, upload_order="plan", page_size=page_size,
+            max_retries=0, chunk_size=1024*1024, upload_root=upload_root)
+        conf = conf.replace("cache_ttl=0", f"cache_ttl={cache_ttl}")
+        if draft_only:
+            conf = conf.replace("draft_only=FALSE", "draft_only=TRUE")
+        if dry_run:
+            conf = conf.replace("dry_run=FALSE", "dry_run=TRUE")
+        (run_dir / "test.ini").write_text(conf + extra_conf)
+        (run_dir / "oa2zenodo_log.csv").unlink(missing_ok=True)
+        p = subprocess.run([sys.executable, OA2ZENODO, *args, "test.ini"], cwd=run_dir,
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        assert p.returncode == returncode, p.stdout
+        run.output = p.stdout
+        # Commands which don't deposit (e.g. writing a plan) write no log
+        return log_statuses(run_dir) if (run_dir / "oa2zenodo_log.csv").exists() else None
+
+    yield server, upload_root, run
+
+def log_statuses(run_dir):
+    """Returns {submission id: [status of each log row]} of the last run."""
+    statuses = {}
+    with open(run_dir / "oa2zenodo_log.csv", newline="") as logfile:
+        for row in csv.DictReader(logfile):
+            statuses.setdefault(int(row["submission_id"]), []).append(row["status"])
+    return statuses
+
+def permitted(server):
+    return [s["serial_number"] for s in server.submissions
+        if any(r["question"]["question_name"] == "Permission to Publish" and r["value"] == "yes" for r in s["responses"])]
+
+def local_files(upload_root, serial):
+    """{name: size} of the files which should be deposited for a submission."""
+    folder = upload_root / f"Group {serial % 10}" / f"ID {serial}"
+    return {f.name: f.stat().st_size for f in folder.iterdir() if f.name != "desktop.ini"}
+
+def depositions(server, serial):
+    """The mock's depositions of a submission, oldest first."""
+    title = f"Synthetic submission {serial}"
+    return [d for _, d in sorted(server.depositions.items()) if d["metadata"].get("title") == title]
+
+def assert_deposited(server, upload_root):
+    """Every permitted submission has exactly one published record holding all of its files, and no drafts."""
+    for serial in permitted(server):
+        deps = depositions(server, serial)
+        assert len(deps) == 1, f"#{serial} has {len(deps)} depositions"
+        assert deps[0]["state"] == "done", f"#{serial} is not published"
+        assert {f["filename"]: f["filesize"] for f in deps[0]["files"]} == local_files(upload_root, serial)
+
+def test_resume_after_interruption(event):
+    server, upload_root, run = event
+    # Stopping before publication leaves every record as a draft, as an interrupted run would
+    statuses = run(draft_only=True)
+    assert all(s == ["Zenodo draft record created"] for serial, s in statuses.items() if serial in permitted(server))
+    uploads = len(server.stats["upload"])
+    statuses = run()
+    assert all(s == ["Zenodo record created and published"] for serial, s in statuses.items() if serial in permitted(server))
+    # The drafts were resumed, rather than recreated or their files uploaded again
+    assert len(server.stats["create"]) == len(permitted(server))
+    assert len(server.stats["upload"]) == uploads
+    assert_deposited(server, upload_root)
+
+def test_resume_finds_lost_publication(event):
+    server, upload_root, run = event
+    run(draft_only=True)
+    # Zenodo published the record, but the response was lost (e.g. a 504), so the state store still has a draft
+    serial = permitted(server)[0]
+    depositions(server, serial)[0].update(state="done", submitted=True)
+    statuses = run()
+    assert statuses[serial] == ["Zenodo record found published whilst resuming"]
+    assert len(server.stats["publish"]) == len(permitted(server)) - 1
+    statuses = run()
+    assert statuses[serial] == ["Zenodo record already published by a previous run"]
+    assert_deposited(server, upload_root)
+
+def test_rerun_without_sync_skips_published(event):
+    server, upload_root, run = event
+    run()
+    statuses = run()
+    assert all(s == ["Zenodo record already published by a previous run"] for serial, s in statuses.items() if serial in permitted(server))
+    assert_deposited(server, upload_root)
+
+def zenodo_requests(server):
+    return sum(len(durations) for endpoint, durations in server.stats.items() if endpoint != "oa_graphql")
+
+def test_sync_unchanged(event):
+    server, upload_root, run = event
+    run()
+    requests = zenodo_requests(server)
+    statuses = run("--sync")
+    assert all(s == ["Zenodo record unchanged"] for serial, s in statuses.items() if serial in permitted(server))
+    # Unchanged records are not contacted
+    assert zenodo_requests(server) == requests
+    assert_deposited(server, upload_root)
+
+def test_sync_metadata_change_edits(event):
+    server, upload_root, run = event
+    run()
+    serial = permitted(server)[0]
+    submission = server.submissions[serial - 1]
+    submission["responses"][0]["value"] = "Corrected abstract"
+    statuses = run("--sync")
+    assert statuses[serial] == ["Zenodo record metadata edited and published"]
+    assert len(server.stats["edit"]) == 1 and not server.stats["newversion"]
+    deps = depositions(server, serial)
+    assert len(deps) == 1 and deps[0]["state"] == "done"
+    assert deps[0]["metadata"]["description"].startswith("Corrected abstract")
+    assert_deposited(server, upload_root)
+
+def test_sync_file_change_creates_new_version(event):
+    server, upload_root, run = event
+    run()
+    serial = permitted(server)[0]
+    folder = upload_root / f"Group {serial % 10}" / f"ID {serial}"
+    with open(folder / "file_0.pdf", "ab") as f:
+        f.write(b"slides corrected")
+    uploads = len(server.stats["upload"])
+    statuses = run("--sync")
+    assert statuses[serial] == ["Zenodo record new version published"]
+    assert len(server.stats["newversion"]) == 1 and not server.stats["edit"]
+    # Only the changed file is uploaded to the new version
+    assert len(server.stats["upload"]) == uploads + 1
+    old, new = depositions(server, serial)
+    assert old["state"] == new["state"] == "done"
+    assert {f["filename"]: f["filesize"] for f in new["files"]} == local_files(upload_root, serial)
+
+def test_sync_new_version_bumps_version(event):
+    server, upload_root, run = event
+    run()
+    serial = permitted(server)[0]
+    folder = upload_root / f"Group {serial % 10}" / f"ID {serial}"
+    for version in ("1.1.0", "1.2.0"):
+        with open(folder / "file_0.pdf", "ab") as f:
+            f.write(b"slides corrected")
+        run("--sync")
+        assert depositions(server, serial)[-1]["metadata"]["version"] == version
+    # Editing the metadata of a new version keeps its version
+    server.submissions[serial - 1]["responses"][0]["value"] = "Corrected abstract"
+    run("--sync")
+    assert depositions(server, serial)[-1]["metadata"]["version"] == "1.2.0"
+    assert depositions(server, serial)[0]["metadata"]["version"] == "1.0.0"
+
+def test_sync_finds_lost_edit(event):
+    server, upload_root, run = event
+    run()
+    serial = permitted(server)[0]
+    server.submissions[serial - 1]["responses"][0]["value"] = "Corrected abstract"
+    # Zenodo opened the edit, but the response was lost, so the record is already being edited
+    depositions(server, serial)[0]["state"] = "inprogress"
+    statuses = run("--sync")
+    assert statuses[serial] == ["Zenodo record metadata edited and published"]
+    assert not server.stats["edit"]
+    assert depositions(server, serial)[0]["metadata"]["description"].startswith("Corrected abstract")
+    assert_deposited(server, upload_root)
+
+def test_sync_finds_lost_new_version(event):
+    server, upload_root, run = event
+    run()
+    serial = permitted(server)[0]
+    with open(upload_root / f"Group {serial % 10}" / f"ID {serial}" / "file_0.pdf", "ab") as f:
+        f.write(b"slides corrected")
+    # Zenodo created the new version, but the response was lost, so its draft is adopted rather than created again
+    record = depositions(server, serial)[0]
+    requests.post(f"{server.url}api/deposit/depositions/{record['id']}/actions/newversion").raise_for_status()
+    draft = depositions(server, serial)[-1]
+    statuses = run("--sync")
+    assert statuses[serial] == ["Zenodo record new version published"]
+    # Only the newversion above
+    assert len(server.stats["newversion"]) == 1
+    old, new = depositions(server, serial)
+    assert new["id"] == draft["id"] and new["state"] == "done"
+    assert new["metadata"]["version"] == "1.1.0"
+    assert {f["filename"]: f["filesize"] for f in new["files"]} == local_files(upload_root, serial)
+
+def test_sync_new_version_discards_open_edit(event):
+    server, upload_root, run = event
+    run()
+    serial = permitted(server)[0]
+    with open(upload_root / f"Group {serial % 10}" / f"ID {serial}" / "file_0.pdf", "ab") as f:
+        f.write(b"slides corrected")
+    # An edit left open (e.g. by a previous sync whose publish failed) must be discarded before a new version
+    depositions(server, serial)[0]["state"] = "inprogress"
+    statuses = run("--sync")
+    assert statuses[serial] == ["Zenodo record new version published"]
+    assert len(server.stats["discard"]) == 1 and len(server.stats["newversion"]) == 1
+    old, new = depositions(server, serial)
+    assert old["state"] == new["state"] == "done"
+
+def test_failed_upload_leaves_draft(event):
+    server, upload_root, run = event
+    run("plan", "--plan-out", "plan.json")
+    # A planned file which cannot be read fails its upload
+    serial = permitted(server)[0]
+    missing = upload_root / f"Group {serial % 10}" / f"ID {serial}" / "file_0.pdf"
+    missing.rename(missing.with_suffix(".moved"))
+    statuses = run("upload", "--plan", "plan.json")
+    assert statuses[serial][0].startswith("Failed to open file")
+    assert "Zenodo record created and published" not in statuses[serial]
+    assert depositions(server, serial)[0]["state"] != "done"
+    assert all(s == ["Zenodo record created and published"] for other, s in statuses.items() if other in permitted(server) and other != serial)
+    # The next run uploads the file to the draft and publishes it, rather than skipping it as published
+    missing.with_suffix(".moved").rename(missing)
+    statuses = run("upload", "--plan", "plan.json")
+    assert statuses[serial] == ["Zenodo record created and published"]
+    assert len(server.stats["create"]) == len(permitted(server))
+    assert_deposited(server, upload_root)
+
+def test_failed_page_logs_dispatched_deposits(event):
+    server, upload_root, run = event
+    # The programme and first page are fetched, then the second page fails
+    server.faults["oa_graphql"] = [None, None, {"status": 503}]
+    statuses = run(returncode=1)
+    assert "Failed to fetch submission (page 2) data" in run.output
+    # The first page's deposits are completed and logged
+    first_page = sorted(s["serial_number"] for s in server.submissions)[:5]
+    assert sorted(statuses) == first_page
+    for serial in first_page:
+        if serial in permitted(server):
+            assert statuses[serial] == ["Zenodo record created and published"]
+            assert depositions(server, serial)[0]["state"] == "done"
+
+def test_paging(event):
+    server, upload_root, run = event
+    serials = sorted(s["serial_number"] for s in server.submissions)
+    # A final page which is full is followed by an empty page, e.g. 12 submissions are 4 pages of 4
+    for page_size, pages in ((5, 3), (4, 4), (100, 1)):
+        fetches = len(server.stats["oa_graphql"])
+        statuses = run("--refresh", page_size=page_size)
+        # The log is in submission order, whichever page each submission was fetched in
+        assert list(statuses) == serials
+        # The programme, and each page
+        assert len(server.stats["oa_graphql"]) - fetches == 1 + pages
+
+def test_cache_ttl(event):
+    server, upload_root, run = event
+    run("fetch")
+    fetches = len(server.stats["oa_graphql"])
+    # The cache is reused whilst it's younger than cache_ttl
+    run("plan", "--plan-out", "plan.json", cache_ttl=3600)
+    assert len(server.stats["oa_graphql"]) == fetches
+    assert "Using cached programme data" in run.output
+    # --refresh, or a cache_ttl of 0, fetches again
+    run("plan", "--plan-out", "plan.json", "--refresh", cache_ttl=3600)
+    assert len(server.stats["oa_graphql"]) > fetches
+    fetches = len(server.stats["oa_graphql"])
+    run("plan", "--plan-out", "plan.json")
+    assert len(server.stats["oa_graphql"]) > fetches
+
+def test_offline(event):
+    server, upload_root, run = event
+    run("--offline", returncode=1)
+    assert "Offline mode requires cached programme data" in run.output
+    run("fetch")
+    requests = sum(len(durations) for durations in server.stats.values())
+    # Offline runs use the cache regardless of age, and are dry runs, so make no requests at all
+    statuses = run("--offline")
+    assert sum(len(durations) for durations in server.stats.values()) == requests
+    assert sorted(statuses) == sorted(s["serial_number"] for s in server.submissions)
+    assert not server.depositions
+
+@pytest.fixture
+def client(monkeypatch):
+    # Shorten the backoff, so that only pauses requested by the server take noticeable time
+    monkeypatch.setattr(oa2zenodo, "RETRY_BACKOFF_MAX", 0.01)
+    return ApiClient(max_retries=3)
+
+def create(server, client, **kwargs):
+    return client.post(server.url + "api/deposit/depositions", json={"metadata": {}}, **kwargs)
+
+@pytest.mark.parametrize("status", [502, 504])
+def test_create_not_retried_if_maybe_processed(server, client, status):
+    server.faults["create"] = [{"status": status, "processed": True}]
+    assert create(server, client).status_code == status
+    # Retrying would have created a second deposition
+    assert len(server.depositions) == 1
+    # An idempotent request is retried
+    server.faults["get"] = [{"status": status}]
+    assert client.get(server.url + "api/deposit/depositions/1").status_code == 200
+
+def test_create_not_retried_after_read_timeout(server, client):
+    server.faults["create"] = [{"delay": 0.5}]
+    with pytest.raises(requests.ReadTimeout):
+        create(server, client, timeout=(5, 0.1))
+    # The timed out request was processed, but not repeated
+    time.sleep(0.6)
+    assert len(server.depositions) == 1
+
+def test_create_retried_if_unprocessed(server, client):
+    server.faults["create"] = [{"status": 429}, {"status": 503}]
+    assert create(server, client).status_code == 201
+    assert len(server.depositions) == 1 and not server.faults["create"]
+
+@pytest.mark.parametrize("headers", [{"Retry-After": "1"},
+    # A reset which has already passed still pauses
+    {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(int(time.time()) - 1)}])
+def test_rate_limit_pauses(server, client, headers):
+    server.faults["create"] = [{"status": 429, "headers": headers}]
+    start = time.monotonic()
+    assert create(server, client).status_code == 201
+    assert time.monotonic() - start >= 0.9
+
+def test_batch_progress_names_event(event):
+    server, upload_root, run = event
+    run(dry_run=True)
+    assert re.search(r"\[DRY\] Created Zenodo record for submission #\d+\n", run.output)
+    # In a batch, each submission is prefixed with its event, as serial numbers may be repeated
+    run(dry_run=True, extra_conf="[OXFORD_ABSTRACTS:second]\nevent_id=1\n")
+    for name in ("test", "second"):
+        assert re.search(rf"\[DRY\] Created Zenodo record for submission {name} #\d+\n", run.output)
+        assert re.search(rf"\[DRY\] Uploaded '.*' for submission {name} #\d+\n", run.output)
+
+def test_errors_exit_non_zero(tmp_path):
+    with pytest.raises(ConfigError):
+        load_event_confs([str(tmp_path / "missing.ini")])
+    with pytest.raises(SystemExit) as e:
+        main([str(tmp_path / "missing.ini")])
+    assert e.value.code == 1
+    # Invalid arguments are reported by argparse
+    with pytest.raises(SystemExit) as e:
+        main(["--refresh", "--offline", str(tmp_path / "missing.ini")])
+    assert e.value.code == 2
+
+def test_upload_scheduler_order_and_limit():
+    for order, expected in (("plan", [5, 1, 9, 3]), ("smallest", [1, 3, 5, 9]), ("largest", [9, 5, 3, 1])):
+        scheduler = UploadScheduler(1, 1, order)
+        # Block the only thread, so every upload is queued before the first is started
+        started = threading.Event()
+        scheduler.submit("blocker", 0, started.wait)
+        done = []
+        futures = [scheduler.submit(("d", i), size, done.append, size) for i, size in enumerate([5, 1, 9, 3])]
+        started.set()
+        for future in futures:
+            future.result()
+        scheduler.shutdown()
+        assert done == expected, order
+    # No deposition has more than file_workers uploads at once, even with free threads
+    scheduler = UploadScheduler(4, 2)
+    lock = threading.Lock()
+    active, peak = 0, 0
+    def upload():
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        time.sleep(0.05)
+        with lock:
+            active -= 1
+    for future in [scheduler.submit("a", 1, upload) for _ in range(4)]:
+        future.result()
+    scheduler.shutdown()
+    assert peak == 2